@@ -6,11 +6,26 @@ Changes:
 
 0.2  - Added --titleX options.
 
+0.3  - Iterative exact test for tables with two columns, 
+       giving the same p-values as before.
+
+0.4  - Log factorials precomputed as an array, sized from the 
+       greatest depth in the evidence files.
+
+0.5  - Added --processes option.
+
+0.6  - Significance cache limited in size, least recently used 
+       tables discarded, added --cache-size option.
+       Cache statistics shown at end.
+
+0.7  - Tests that can not be significant are screened out before 
+       the exact test. Counts of tests screened out shown at end.
+
 """
 
-VERSION = '0.2'
+VERSION = '0.7'
 
-import sys, re, numpy, itertools, os
+import sys, re, numpy, itertools, os, time, math, collections, multiprocessing
 
 USAGE = """\
 Usage:
@@ -24,6 +39,9 @@ Options:
 
   --title1 "xyz"   - Column title for first evidence file in output
   --title2 "xyz"   - Column title for second evidence file in output
+  --processes N    - Test positions in N processes (default 1)
+  --cache-size N   - Remember p-values of up to N different tables 
+                     (default 100000, in each process)
 
 1st-evidence.txt and 2nd-evidence.txt should be *-evidence.txt files 
 produced by shrimp_consensus.py
@@ -74,14 +92,42 @@ def read_file(filename):
 
 
 
-LOG_FAC_CACHE = [ 0.0 ]
+DEPTH_PATTERN = re.compile(r'"x([0-9]+)')
+
+def max_depth(filename):
+    """ Greatest total of the counts on any line of an evidence file
+        (insertion and substitution evidence together, so an overestimate). """
+    
+    result = 0
+    f = open(filename,'rb')
+    f.readline()
+    for line in f:
+        result = max(result, sum(map(int, DEPTH_PATTERN.findall(line))))
+    return result
+
+
+# log(n!) for n up to len(LOG_FAC)-1, as an array for indexing with 
+# arrays of counts, and as a list of floats for single lookups.
+# Accumulated one term at a time, as in earlier versions, 
+# so the values (and so p-values) are the same.
+LOG_FAC = numpy.zeros(1)
+LOG_FAC_LIST = [ 0.0 ]
+
+def ensure_log_fac(n):
+    """ Extend LOG_FAC to include n, at least doubling its size. """
+    
+    global LOG_FAC, LOG_FAC_LIST
+    size = len(LOG_FAC)
+    if n < size: return
+    terms = numpy.log(numpy.arange(size, max(n+1,size*2), dtype='float64'))
+    terms[0] += LOG_FAC[-1]
+    LOG_FAC = numpy.concatenate((LOG_FAC, numpy.add.accumulate(terms)))
+    LOG_FAC_LIST = LOG_FAC.tolist()
+
 def log_fac(n):
-    try:
-        return LOG_FAC_CACHE[n]
-    except IndexError:
-        while len(LOG_FAC_CACHE) <= n:
-            LOG_FAC_CACHE.append(LOG_FAC_CACHE[-1]+numpy.log(len(LOG_FAC_CACHE)))
-        return LOG_FAC_CACHE[n]  
+    if n >= len(LOG_FAC_LIST):
+        ensure_log_fac(n)
+    return LOG_FAC_LIST[n]
 
 SUM_ERROR_MARGIN = 0.999999
 
@@ -129,7 +175,128 @@ def fexact(matrix, significance_cutoff):
     
     return significance[0]
 
-SIG_CACHE = { }
+def fexact_rx2(matrix, significance_cutoff):
+    """ fexact for a table with two columns, without recursion.
+    
+        Tables are enumerated in the same order as fexact, and their
+        probabilities are summed in the same order, so the result is
+        identical. The first column is enumerated a row at a time (the 
+        second column follows from it), except for the last two rows, 
+        which have one free cell between them and are done as a vector. """
+    
+    matrix = numpy.asarray(matrix)
+    n_row, n_col = matrix.shape
+    assert n_col == 2
+    if n_row < 2:
+        return fexact(matrix, significance_cutoff)
+    
+    row_sum = numpy.sum(matrix,1)
+    col_sum = numpy.sum(matrix,0)
+    n = numpy.sum(row_sum)
+    
+    ensure_log_fac(n)
+    log_facs = LOG_FAC
+    log_fac_list = LOG_FAC_LIST
+
+    cutoff = sum(log_facs[matrix.ravel()].tolist()) * SUM_ERROR_MARGIN
+
+    const_part = sum(log_facs[row_sum].tolist()) + sum(log_facs[col_sum].tolist()) - log_fac_list[n]
+    
+    row_sum = [ int(item) for item in row_sum ]
+    tail_sum = [ sum(row_sum[row+1:]) for row in xrange(n_row) ]
+    
+    significance = 0.0
+    
+    #For the rows before the last two, cells of the first column,
+    #the remainder of the column before each row, and the total of 
+    #log_fac of the cells before each row
+    last = n_row-2
+    cells = [ None ] * last
+    cell_max = [ None ] * last
+    remainder = [ int(col_sum[0]) ] + [ None ] * last
+    total = [ 0.0 ] + [ None ] * last
+    
+    row = 0
+    while row >= 0:
+        if row < last:
+            if cells[row] is None:
+                cells[row] = max(0, remainder[row] - tail_sum[row])
+                cell_max[row] = min(remainder[row], row_sum[row])
+            else:
+                cells[row] += 1
+            
+            if cells[row] > cell_max[row]:
+                cells[row] = None
+                row -= 1
+            else:
+                remainder[row+1] = remainder[row] - cells[row]
+                total[row+1] = total[row] + log_fac_list[cells[row]]
+                row += 1
+            continue
+        
+        #Last two rows: every value of the free cell at once
+        col_remainder = remainder[last]
+        i = numpy.arange(max(0, col_remainder - row_sum[last+1]), 
+                         min(col_remainder, row_sum[last])+1)
+        next_total = total[last] + log_facs[i]
+        next_total = next_total + log_facs[col_remainder - i]
+        for other_row in xrange(last):
+            next_total = next_total + log_fac_list[row_sum[other_row] - cells[other_row]]
+        next_total = next_total + log_facs[row_sum[last] - i]
+        next_total = next_total + log_facs[row_sum[last+1] - (col_remainder - i)]
+        
+        next_total = next_total[next_total >= cutoff]
+        if len(next_total):
+            #Summed one at a time, as fexact does
+            significance = numpy.add.accumulate(
+                numpy.concatenate(([ significance ], numpy.exp( const_part-next_total ))) )[-1]
+            if significance > significance_cutoff:
+                return None
+        row -= 1
+    
+    return significance
+
+class Significance_cache(object):
+    """ p-values of recently tested tables, keyed by table (a tuple of 
+        rows) and cutoff. Holds up to size entries, discarding the least 
+        recently used. """
+    
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fexact_seconds = 0.0
+    
+    def get(self, rows, cutoff):
+        key = (rows, cutoff)
+        try:
+            value = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            start = time.time()
+            value = fexact_rx2(numpy.array(rows), cutoff)
+            self.fexact_seconds += time.time() - start
+            if len(self.entries) >= self.size:
+                if not self.entries: return value
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        self.entries[key] = value
+        return value
+    
+    def counts(self):
+        return [ self.hits, self.misses, self.evictions, self.fexact_seconds ]
+    
+    def summary(self, counts):
+        hits, misses, evictions, fexact_seconds = counts
+        return 'Significance cache: %d hits, %d misses (%.1f%% hits), %d evictions, %.1f seconds in fexact' % (
+            hits, misses, 100.0*hits/max(1,hits+misses), evictions, fexact_seconds)
+
+DEFAULT_CACHE_SIZE = 100000
+
+SIG_CACHE = Significance_cache(DEFAULT_CACHE_SIZE)
 def significance(ev1, ev2, cutoff):
     # Avoid duplicates in SIG_CACHE
     if ev2 < ev1:
@@ -155,10 +322,140 @@ def significance(ev1, ev2, cutoff):
     #    print matrix, s
     #return fexact(matrix)
     
-    key = (tuple(matrix.ravel()),cutoff)
-    if key not in SIG_CACHE:
-        SIG_CACHE[key] = fexact(matrix,cutoff)    
-    return SIG_CACHE[key]
+    #Rows in a standard order, so the same table with its rows in any 
+    #order has one entry. Smallest rows first, as fexact_rx2 enumerates
+    #all but the last two rows one table at a time.
+    rows = tuple(sorted([ tuple(row) for row in matrix.tolist() ], key=lambda row: (sum(row), row)))
+    return SIG_CACHE.get(rows, cutoff)
+
+
+# Stages each test (insertion or substitution evidence at a position) 
+# goes through, and how many tests went no further than each stage
+SCREEN_STAGES = [ 
+    'without evidence in both files', 
+    'with a single allele shared by both files', 
+    'where the observed table alone is above the cutoff', 
+    'given the exact test',
+]
+SCREEN_COUNTS = [ 0 ] * len(SCREEN_STAGES)
+
+# Margin allowed for rounding when comparing the probability of 
+# the observed table with the cutoff
+BOUND_MARGIN = 1.000001
+
+def single_allele(evidence):
+    """ Allele (still quoted) if undecoded evidence is for one allele, otherwise None. """
+    
+    if evidence.count('"x') != 1: return None
+    return evidence[:evidence.index('"x')+1]
+
+def log_table_probability(ev1, ev2):
+    """ log of the probability of a table, given its row and column totals.
+        The p-value from fexact is at least this probability, 
+        as it includes the table itself. """
+    
+    rows = { }
+    for item in ev1:
+        rows[item[0]] = [ item[1], 0 ]
+    for item in ev2:
+        rows.setdefault(item[0], [ 0, 0 ])[1] = item[1]
+    
+    col_sum = [ 0, 0 ]
+    result = 0.0
+    for a, b in rows.values():
+        result += log_fac(a+b) - log_fac(a) - log_fac(b)
+        col_sum[0] += a
+        col_sum[1] += b
+    return result + log_fac(col_sum[0]) + log_fac(col_sum[1]) - log_fac(col_sum[0]+col_sum[1])
+
+def screen(evidence1, evidence2, cutoff):
+    """ Decoded evidence from two files, or None if 
+        the difference between them can not be significant. """
+    
+    if not evidence1 or not evidence2:
+        SCREEN_COUNTS[0] += 1
+        return None
+    
+    #A table with one row has p-value 1
+    if cutoff < SUM_ERROR_MARGIN:
+        allele = single_allele(evidence1)
+        if allele is not None and allele == single_allele(evidence2):
+            SCREEN_COUNTS[1] += 1
+            return None
+    
+    ev1 = decode_evidence(evidence1)
+    ev2 = decode_evidence(evidence2)
+    if cutoff > 0 and log_table_probability(ev1, ev2) > math.log(cutoff * BOUND_MARGIN):
+        SCREEN_COUNTS[2] += 1
+        return None
+    
+    SCREEN_COUNTS[3] += 1
+    return ev1, ev2
+
+def screen_summary(counts):
+    lines = [ '%d tests:' % sum(counts) ]
+    for stage, count in zip(SCREEN_STAGES, counts):
+        lines.append('  %d %s' % (count, stage))
+    return '\n'.join(lines)
+
+
+def test_position(pos, ins1, sub1, ins2, sub2, ref, cutoff):
+    """ Output lines for any significant differences at a position. """
+    
+    result = [ ]
+    
+    dec_ins = screen(ins1, ins2, cutoff)
+    if dec_ins:
+        sig = significance(dec_ins[0], dec_ins[1], cutoff)    
+        if sig is not None and sig <= cutoff:
+            result.append('%d,%s,"","%s","%s",%g' % (pos, 'insertion-before', ins1.replace('"',"'"), ins2.replace('"',"'"), sig))
+
+    dec_sub = screen(sub1, sub2, cutoff)
+    if dec_sub:
+        dec_sub1, dec_sub2 = dec_sub
+        sig = significance(dec_sub1, dec_sub2, cutoff)        
+        if sig is not None and sig <= cutoff:
+            if dec_sub1[0][0] == '-' or dec_sub2[0][0] == '-':
+                what = 'deletion'
+            elif dec_sub1[0][0] != dec_sub2[0][0]:
+                what = 'substitution'
+            else:
+                what = 'different mix'
+            result.append('%d,%s,%s,"%s","%s",%g' % (pos, what, ref, sub1.replace('"',"'"), sub2.replace('"',"'"), sig))
+    
+    return result
+
+def read_positions(filename1, filename2):
+    """ Yield (pos, ins1, sub1, ins2, sub2, ref) from two evidence files. """
+    
+    for (pos1, ins1, sub1, ref1), (pos2, ins2, sub2, ref2) in itertools.izip(read_file(filename1), read_file(filename2)):
+        assert pos1 == pos2 and ref1 == ref2
+        yield pos1, ins1, sub1, ins2, sub2, ref1
+
+CHUNK_SIZE = 10000
+
+def read_chunks(positions):
+    """ Lists of CHUNK_SIZE positions. """
+    
+    while True:
+        chunk = list(itertools.islice(positions, CHUNK_SIZE))
+        if not chunk: break
+        yield chunk
+
+def all_counts():
+    """ SIG_CACHE's counts followed by SCREEN_COUNTS. """
+    
+    return SIG_CACHE.counts() + SCREEN_COUNTS
+
+def test_chunk(chunk, cutoff):
+    """ Output lines for a chunk of positions, 
+        and the change in all_counts(). """
+    
+    before = all_counts()
+    result = [ ]
+    for item in chunk:
+        result.extend(test_position(*(item + (cutoff,))))
+    return result, [ a-b for a, b in zip(all_counts(), before) ]
 
 
 def title_from_filename(filename):
@@ -174,6 +471,8 @@ def title_from_filename(filename):
 args = sys.argv[1:]
 title1, args = get_option_value(args, '--title1', str, None)
 title2, args = get_option_value(args, '--title1', str, None)
+n_processes, args = get_option_value(args, '--processes', int, 1)
+SIG_CACHE.size, args = get_option_value(args, '--cache-size', int, DEFAULT_CACHE_SIZE)
 
 if len(args) != 3:
     print >> sys.stderr, USAGE
@@ -186,6 +485,10 @@ cutoff = float(args[2])
 if title1 is None: title1 = title_from_filename(filename1)
 if title2 is None: title2 = title_from_filename(filename2)
 
+status('Finding greatest depth')
+ensure_log_fac(max_depth(filename1) + max_depth(filename2))
+status('')
+
 n = 1
 while significance([('A',n)],[('T',n)],1.0) > cutoff:
     n += 1
@@ -196,34 +499,59 @@ print '%d,depth required to call substitution (greater if there are errors in th
 
 print 'Position,Type,Reference,%s,%s,p-value (no correction for multiple testing)' % (title1, title2)
 
-for (pos1, ins1, sub1, ref1), (pos2, ins2, sub2, ref2) in itertools.izip(read_file(filename1), read_file(filename2)):
-    assert pos1 == pos2 and ref1 == ref2
-
-    if pos1 % 1000 == 0:
-        status('Testing %d' % pos1)
-
-    #if pos1 not in (692366, 917937, 1349539, 1110346, 1411407): continue
+positions = read_positions(filename1, filename2)
 
-    dec_ins1 = decode_evidence(ins1)
-    dec_ins2 = decode_evidence(ins2)
-    if dec_ins1 and dec_ins2:
-        sig = significance(decode_evidence(ins1), decode_evidence(ins2), cutoff)    
-        if sig is not None and sig <= cutoff:
+if n_processes <= 1:
+    for item in positions:
+        if item[0] % 1000 == 0:
+            status('Testing %d' % item[0])
+        lines = test_position(*(item + (cutoff,)))
+        if lines:
             status('')
-            print '%d,%s,"","%s","%s",%g' % (pos1, 'insertion-before', ins1.replace('"',"'"), ins2.replace('"',"'"), sig)
+            print '\n'.join(lines)
 
-    dec_sub1 = decode_evidence(sub1)
-    dec_sub2 = decode_evidence(sub2)
-    if dec_sub1 and dec_sub2:
-        sig = significance(dec_sub1, dec_sub2, cutoff)        
-        if sig is not None and sig <= cutoff:
-            if dec_sub1[0][0] == '-' or dec_sub2[0][0] == '-':
-                what = 'deletion'
-            elif dec_sub1[0][0] != dec_sub2[0][0]:
-                what = 'substitution'
-            else:
-                what = 'different mix'
+else:
+    chunks = read_chunks(positions)
+    
+    #The first chunk is tested here, so that the workers start 
+    #with its results in their copies of SIG_CACHE
+    for chunk in itertools.islice(chunks, 1):
+        status('Testing %d' % chunk[-1][0])
+        lines, chunk_counts = test_chunk(chunk, cutoff)
+        if lines:
             status('')
-            print '%d,%s,%s,"%s","%s",%g' % (pos1, what, ref1, sub1.replace('"',"'"), sub2.replace('"',"'"), sig)
+            print '\n'.join(lines)
+    
+    pool = multiprocessing.Pool(n_processes)
+    
+    #A few chunks ahead of the output, so the whole file is not read into memory
+    pending = collections.deque()
+    worker_counts = [ 0 ] * len(all_counts())
+    def write_pending():
+        last_position, result = pending.popleft()
+        lines, chunk_counts = result.get()
+        for i in xrange(len(worker_counts)):
+            worker_counts[i] += chunk_counts[i]
+        if lines:
+            status('')
+            print '\n'.join(lines)
+        status('Testing %d' % last_position)
+        
+    for chunk in chunks:
+        pending.append( (chunk[-1][0], pool.apply_async(test_chunk, (chunk, cutoff))) )
+        if len(pending) >= n_processes*2:
+            write_pending()
+    while pending:
+        write_pending()
+    
+    pool.close()
+    pool.join()
 
 status('')
+
+counts = all_counts()
+if n_processes > 1:
+    counts = [ a+b for a, b in zip(counts, worker_counts) ]
+n_cache_counts = len(SIG_CACHE.counts())
+print >> sys.stderr, screen_summary(counts[n_cache_counts:])
+print >> sys.stderr, SIG_CACHE.summary(counts[:n_cache_counts])
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""
+
+Aligners that shrimp_run.py can use. Each produces hits in SHRiMP's
+output format, which is what shrimp_consensus.py reads.
+
+  shrimp - SHRiMP's rmapper-ls, or rmapper-cs for SOLiD reads (the default)
+  fake   - a deterministic stand-in for SHRiMP, for testing and benchmarking
+           without the real binary. Run as:
+
+             shrimp_aligners.py fake [--max-mismatches N] reads.fa reference.fa
+
+           It finds each read (either strand) where its first SEED_LENGTH
+           bases match the reference exactly and the whole read has no
+           more than N (default 3) substitutions. If there are more, it
+           tries a single insertion or deletion of up to MAX_GAP bases 
+           after the seed, counted as one more substitution.
+           The reference is indexed in memory, so keep it small.
+
+0.1 - initial version, split out of shrimp_run.py, added fake aligner
+
+0.2 - fake aligner finds hits with an insertion or deletion
+
+"""
+
+VERSION = '0.2'
+
+import sys, os, shlex, string, subprocess
+
+
+class Aligner(object):
+    """ How shrimp_run.py runs an aligner and reads its output.
+
+        options are extra command line options for the aligner. """
+
+    def __init__(self, options, solid):
+        self.options = options
+        self.solid = solid
+
+    def command(self, reads_filename, reference_filename):
+        """ Command to align the reads in a FASTA file to a reference,
+            writing hits to standard output, as a list of arguments. """
+        raise NotImplementedError
+
+    def run(self, reads_filename, reference_filename, output_filename, verbose):
+        """ Start the aligner, with output to output_filename,
+            or to a pipe (the Popen's stdout) if output_filename is None.
+            Returns a subprocess.Popen. """
+
+        if output_filename is None:
+            output_file = subprocess.PIPE
+        else:
+            output_file = open(output_filename,'wb')
+        if verbose:
+            error_file = None
+        else:
+            error_file = open(os.devnull,'wb')
+        try:
+            return subprocess.Popen(self.command(reads_filename, reference_filename),
+                                    stdout=output_file, stderr=error_file, close_fds=True)
+        finally:
+            if output_filename is not None: output_file.close()
+            if error_file is not None: error_file.close()
+
+    def hit_lines(self, output_file):
+        """ Lines of SHRiMP format hits from the aligner's output. """
+        return output_file
+
+    def mapped_read_name(self, line):
+        """ Name of the read a line from hit_lines is a hit for,
+            or None if it is not a hit. """
+        if not line.startswith('>'): return None
+        return line.split(None,1)[0][1:]
+
+
+class Shrimp_aligner(Aligner):
+    def command(self, reads_filename, reference_filename):
+        if self.solid:
+            shrimp = 'rmapper-cs'
+        else:
+            shrimp = 'rmapper-ls'
+
+        #Options were once passed through the shell, so may need splitting
+        return [ shrimp ] + shlex.split(' '.join(self.options)) + [ reads_filename, reference_filename ]
+
+
+class Fake_aligner(Aligner):
+    def command(self, reads_filename, reference_filename):
+        return [ sys.executable, os.path.abspath(__file__.replace('.pyc','.py')), 'fake' ] + \
+               self.options + [ reads_filename, reference_filename ]
+
+
+ALIGNERS = {
+    'shrimp' : Shrimp_aligner,
+    'fake' : Fake_aligner,
+}
+
+def get_aligner(name, options, solid):
+    assert name in ALIGNERS, 'Unknown aligner: ' + name
+    return ALIGNERS[name](options, solid)
+
+
+
+SEED_LENGTH = 12
+MAX_GAP = 3
+
+COMPLEMENT = string.maketrans('ACGTacgt','TGCAtgca')
+
+def read_fasta(filename):
+    name = None
+    parts = [ ]
+    for line in open(filename,'rb'):
+        if line.startswith('>'):
+            if name is not None:
+                yield name, ''.join(parts)
+            name = line[1:].split()[0]
+            parts = [ ]
+        else:
+            parts.append(line.strip())
+    if name is not None:
+        yield name, ''.join(parts)
+
+def fake_edit_string(read_ali, ref_ali):
+    """ SHRiMP edit string for an alignment (with '-' in either
+        sequence for an insertion or deletion, in the read's orientation),
+        and the number of substitutions. """
+
+    result = [ ]
+    n_matches = 0
+    n_substitutions = 0
+    for i in xrange(len(read_ali)):
+        if read_ali[i] == ref_ali[i]:
+            n_matches += 1
+            continue
+        
+        if n_matches:
+            result.append(str(n_matches))
+            n_matches = 0
+        if ref_ali[i] != '-':
+            if read_ali[i] != '-':
+                n_substitutions += 1
+            result.append(read_ali[i])
+        elif i and ref_ali[i-1] == '-':
+            result[-1] = result[-1][:-1] + read_ali[i] + ')'
+        else:
+            result.append('(' + read_ali[i] + ')')
+    if n_matches:
+        result.append(str(n_matches))
+    return ''.join(result), n_substitutions
+
+def fake_gapped_alignment(seq, ref_seq, position, max_substitutions):
+    """ Alignment of seq (as oriented on the reference) starting at 
+        position in ref_seq, with one insertion or deletion of up to
+        MAX_GAP bases after the first SEED_LENGTH bases, and the fewest 
+        substitutions (no more than max_substitutions). 
+        
+        Returns (reference alignment, read alignment), or None. """
+
+    #Substitutions in seq[:i] against ref_seq from position+offset, 
+    #positions off the end of the reference count as too many
+    len_seq = len(seq)
+    too_many = len_seq + 1
+    mismatches = { }
+    for offset in xrange(-MAX_GAP, MAX_GAP+1):
+        counts = [ 0 ]
+        for i in xrange(len_seq):
+            j = position + i + offset
+            if j < 0 or j >= len(ref_seq):
+                counts.append(counts[-1] + too_many)
+            else:
+                counts.append(counts[-1] + (seq[i] != ref_seq[j]))
+        mismatches[offset] = counts
+    
+    best = None
+    for k in xrange(SEED_LENGTH, len_seq):
+        before = mismatches[0][k]
+        if before > max_substitutions: break
+        for gap in xrange(1, MAX_GAP+1):
+            #Insertion of seq[k:k+gap]
+            if k+gap < len_seq:
+                n = before + mismatches[-gap][len_seq] - mismatches[-gap][k+gap]
+                if n <= max_substitutions and (best is None or n < best[0]):
+                    best = (n, k, -gap)
+            #Deletion of ref_seq[position+k:position+k+gap]
+            n = before + mismatches[gap][len_seq] - mismatches[gap][k]
+            if n <= max_substitutions and (best is None or n < best[0]):
+                best = (n, k, gap)
+    
+    if best is None: return None
+    n, k, gap = best
+    start = position + k
+    if gap < 0:
+        return (ref_seq[position:start] + '-'*-gap + ref_seq[start:position+len_seq+gap],
+                seq)
+    else:
+        return (ref_seq[position:position+len_seq+gap],
+                seq[:k] + '-'*gap + seq[k:])
+
+def seed_index(references):
+    """ { seed : [ (reference number, position) ] } """
+
+    index = { }
+    for i, (ref_name, ref_seq) in enumerate(references):
+        for position in xrange(len(ref_seq)-SEED_LENGTH+1):
+            index.setdefault(ref_seq[position:position+SEED_LENGTH], [ ]).append((i, position))
+    return index
+
+def fake_align(reads_filename, reference_filename, max_mismatches, output_file):
+    references = [ (name, seq.upper()) for name, seq in read_fasta(reference_filename) ]
+    index = seed_index(references)
+
+    output_file.write('#FORMAT: readname contigname strand contigstart contigend readstart readend readlength score editstring\n')
+    for read_name, read_seq in read_fasta(reads_filename):
+        read_seq = read_seq.upper()
+        if len(read_seq) < SEED_LENGTH: continue
+
+        for strand, seq in (('+', read_seq), ('-', read_seq.translate(COMPLEMENT)[::-1])):
+            for i, position in index.get(seq[:SEED_LENGTH], ()):
+                ref_name, ref_seq = references[i]
+                
+                #As SHRiMP, edit strings for '-' hits are of the read 
+                #against the reverse complement of the reference
+                corresp_seq = ref_seq[position:position+len(seq)]
+                if strand == '-':
+                    corresp_seq = corresp_seq.translate(COMPLEMENT)[::-1]
+                ref_length = len(seq)
+                gap_length = 0
+                n_substitutions = None
+                if len(corresp_seq) == len(seq):
+                    edit_string, n_substitutions = fake_edit_string(read_seq, corresp_seq)
+                
+                if n_substitutions is None or n_substitutions > max_mismatches:
+                    alignment = fake_gapped_alignment(seq, ref_seq, position, max_mismatches-1)
+                    if alignment is None: continue
+                    ref_ali, read_ali = alignment
+                    ref_length = len(ref_ali) - ref_ali.count('-')
+                    gap_length = len(ref_ali) - len(seq) + ref_ali.count('-')
+                    if strand == '-':
+                        ref_ali = ref_ali.translate(COMPLEMENT)[::-1]
+                        read_ali = read_ali.translate(COMPLEMENT)[::-1]
+                    edit_string, n_substitutions = fake_edit_string(read_ali, ref_ali)
+                
+                output_file.write('>%s\t%s\t%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\n' % (
+                    read_name, ref_name, strand,
+                    position+1, position+ref_length,
+                    1, len(seq), len(seq),
+                    10*len(seq) - 15*n_substitutions - (gap_length and 40 + 7*gap_length),
+                    edit_string))
+
+
+def main(args):
+    if len(args) >= 2 and args[1] == 'fake':
+        args = args[2:]
+        max_mismatches = 3
+        if args[:1] == [ '--max-mismatches' ]:
+            max_mismatches = int(args[1])
+            args = args[2:]
+        if len(args) == 2:
+            fake_align(args[0], args[1], max_mismatches, sys.stdout)
+            return 0
+
+    sys.stderr.write(__doc__)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit( main(sys.argv) )
+
@@ -0,0 +1,558 @@
+#!/usr/bin/env python2.6
+
+"""
+
+Micro-benchmarks for the SHRiMP tools
+
+0.1 - initial version, edit string decoding
+
+0.2 - reads file readers
+
+0.3 - whole pipeline, with a fake aligner
+
+0.4 - consistency checks
+
+"""
+
+VERSION = '0.4'
+
+import sys, os, time, random, shutil, subprocess
+
+import shrimp_consensus, shrimp_reads
+from shrimp_aligners import SEED_LENGTH
+from shrimp_consensus import status, pretty_number, reverse_complement, \
+                             hit_line_read_name, get_option_value, get_flag
+from Bio import SeqIO
+
+
+USAGE = """\
+
+Usage:
+
+  shrimp_benchmark.py [options] edit-strings working_dir
+
+      Time decoding of the edit strings in working_dir/shrimp_hits.txt,
+      comparing the current decoder with the original one.
+      working_dir was created by shrimp_run.py.
+
+  shrimp_benchmark.py [options] [--solid] readers reads_file [...]
+
+      Time reading reads files (FASTA, FASTQ, CSFASTA, possibly gzipped)
+      into batches, comparing shrimp_reads.py with the readline() readers 
+      of shrimp_run.py 0.7.
+
+  shrimp_benchmark.py [options] pipeline working_dir
+
+      Time shrimp_run.py --aligner fake then shrimp_consensus.py
+      on a synthetic reference and reads, created in working_dir.
+      Results are deterministic, so output can also be compared
+      between versions.
+
+  shrimp_benchmark.py check working_dir
+
+      Check the SHRiMP tools give consistent results, using a small 
+      synthetic reference and reads, created in working_dir:
+        - shrimp_consensus.py with reads divided into more shards than
+          processes counts the same as in a single process
+        - a substitution, insertion or deletion in reads from either 
+          strand is reported by shrimp_consensus.py at the right position, 
+          aligned by the fake aligner (and the original edit string decoder 
+          agrees with the current one on these hits)
+        - letters other than ACGT-NX (eg an ambiguity code in the
+          reference) are counted as alleles in their own right
+
+Options:
+
+  --limit N       - Only use the first N hits (default: all)
+  --repeat N      - Time each decoder N times, take the best (default: 3)
+  --batch-size N  - Bases per batch when reading reads (default: 30000000)
+  --reads N       - Number of read pairs for pipeline (default: 100000)
+  --cpus N        - --cpus for shrimp_run.py in pipeline (default: 2)
+
+"""
+
+
+def original_edit_string_to_alignment(edit_string, corresp_seq):
+    """ edit_string_to_alignment as in shrimp_consensus.py 0.15 """
+
+    len_edit_string = len(edit_string)
+    read_ali = ''
+    contig_ali = ''
+    i = 0
+    while i < len_edit_string:
+        if edit_string[i] == '(':
+            j = i + 1
+            while edit_string[j] != ')': j += 1
+            gap = edit_string[i+1:j].upper()
+
+            read_ali += gap
+            contig_ali += '-' * len(gap)
+
+            i = j + 1
+        elif edit_string[i].isdigit():
+            j = i
+            while j < len_edit_string and edit_string[j].isdigit(): j += 1
+            n_matches = int(edit_string[i:j].upper())
+
+            read_ali += corresp_seq[:n_matches]
+            contig_ali += corresp_seq[:n_matches]
+            corresp_seq = corresp_seq[n_matches:]
+
+            i = j
+        elif edit_string[i] == '-':
+            j = i
+            while j < len_edit_string and edit_string[j] == '-': j += 1
+
+            n_deleted = j-i
+            contig_ali += corresp_seq[:n_deleted]
+            read_ali += '-' * n_deleted
+            corresp_seq = corresp_seq[n_deleted:]
+
+            i = j
+        else:
+            contig_ali += corresp_seq[:1]
+            read_ali += edit_string[i].upper()
+            corresp_seq = corresp_seq[1:]
+
+            i += 1
+
+    return contig_ali, read_ali
+
+
+def original_read_solid(filename):
+    """ read_solid as in shrimp_run.py 0.7 """
+
+    reads_file = shrimp_reads.open_possibly_compressed_file(filename)
+    
+    while True:
+        line1 = reads_file.readline()
+        while line1.startswith('#'):
+            line1 = reads_file.readline()
+        if not line1: break
+        assert line1.startswith('>'), 'Not a SOLiD CSFASTA file?'
+        line2 = reads_file.readline()
+
+        read_name = line1.rstrip('\n')[1:]
+        read_seq = line2.rstrip('\n')
+        yield read_name, read_seq
+
+def original_read_illumina(filename):
+    """ read_illumina as in shrimp_run.py 0.7 """
+
+    reads_file = shrimp_reads.open_possibly_compressed_file(filename)
+    
+    while True:
+        line1 = reads_file.readline()
+        if not line1: break
+        line2 = reads_file.readline()
+        line3 = reads_file.readline()
+        line4 = reads_file.readline()
+            
+        assert line1.startswith('@'), 'Not an Illumina FASTQ file?'
+        assert line3.startswith('+'), 'Not an Illumina FASTQ file?'
+            
+        read_name = line1.rstrip('\n')[1:]
+        read_seq = line2.rstrip('\n')
+        yield read_name, read_seq
+
+def original_read_fasta(filename):
+    """ read_fasta as in shrimp_run.py 0.7 """
+
+    reads_file = shrimp_reads.open_possibly_compressed_file(filename)
+    
+    line = reads_file.readline()
+    while line:
+        line = line.rstrip()
+        assert line.startswith('>'), 'Not a FASTA file?'
+        read_name = line[1:].split()[0]
+        
+        line = reads_file.readline()
+        parts = [ ]
+        while line and not line.startswith('>'):
+            parts.append(line.rstrip())
+            line = reads_file.readline()
+        
+        yield read_name, ''.join(parts)
+
+def original_read_batches(filename, batch_size, solid):
+    """ Batching loop as in shrimp_run.py 0.7 """
+
+    if solid:
+        reader = original_read_solid(filename)
+    elif shrimp_reads.open_possibly_compressed_file(filename).readline().startswith('>'):
+        reader = original_read_fasta(filename)
+    else:
+        reader = original_read_illumina(filename)
+    
+    while True:
+        read_set = [ ]
+        read_set_bases = 0
+        for read_name, read_seq in reader:
+            read_set.append((read_name, read_seq))
+            read_set_bases += len(read_seq)
+            if read_set_bases >= batch_size: break
+        if not read_set: break
+        yield read_set
+
+
+def load_reference(working_dir):
+    reference = { }
+    for record in SeqIO.parse(open(os.path.join(working_dir,'reference.fa'),'rU'), 'fasta'):
+        reference[record.id] = record.seq.tostring().upper()
+    return reference
+
+
+def load_edit_strings(working_dir, limit):
+    """ [ (edit string, corresponding reference sequence) ] from a hit file. """
+
+    reference = load_reference(working_dir)
+
+    result = [ ]
+    for line in open(os.path.join(working_dir,'shrimp_hits.txt'),'rb'):
+        if line.startswith('#'): continue
+        if limit is not None and len(result) >= limit: break
+
+        parts = line.rstrip().split('\t')
+        contig_name = parts[1].split()[0]
+        corresp_seq = reference[contig_name][int(parts[3])-1:int(parts[4])]
+        if parts[2] != '+':
+            corresp_seq = reverse_complement(corresp_seq)
+        result.append((parts[9], corresp_seq))
+
+        if len(result) % 10000 == 0:
+            status('Loading hit %s' % pretty_number(len(result)))
+    status('')
+    return result
+
+
+def time_function(function, items, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for edit_string, corresp_seq in items:
+            function(edit_string, corresp_seq)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_edit_strings(working_dir, limit, repeat):
+    items = load_edit_strings(working_dir, limit)
+    if not items:
+        sys.stderr.write('No hits\n')
+        return 1
+
+    for edit_string, corresp_seq in items:
+        assert shrimp_consensus.edit_string_to_alignment(edit_string, corresp_seq) == \
+               original_edit_string_to_alignment(edit_string, corresp_seq), \
+               'Decoders disagree on ' + edit_string
+
+    n_distinct = len(set([ item[0] for item in items ]))
+
+    original_time = time_function(original_edit_string_to_alignment, items, repeat)
+    shrimp_consensus.EDIT_STRING_CACHE.clear()
+    current_time = time_function(shrimp_consensus.edit_string_to_alignment, items, repeat)
+
+    print '%s hits, %s distinct edit strings' % (pretty_number(len(items)), pretty_number(n_distinct))
+    print '%-10s %10.3fs %12.0f hits/s' % ('original', original_time, len(items)/max(original_time,1e-9))
+    print '%-10s %10.3fs %12.0f hits/s' % ('current', current_time, len(items)/max(current_time,1e-9))
+    print '%.1fx speedup' % (original_time/max(current_time,1e-9))
+    return 0
+
+
+def time_reader(function, filename, batch_size, solid, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        n_reads = 0
+        n_batches = 0
+        for batch in function(filename, batch_size, solid):
+            n_reads += len(batch)
+            n_batches += 1
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, n_reads, n_batches
+
+
+def benchmark_readers(filenames, batch_size, solid, repeat):
+    def current_read_batches(filename, batch_size, solid):
+        return shrimp_reads.read_batches(filename, batch_size, None, solid)
+
+    for filename in filenames:
+        for original, current in map(None, 
+                original_read_batches(filename, batch_size, solid),
+                current_read_batches(filename, batch_size, solid)):
+            assert original == current, 'Readers disagree on ' + filename
+
+        original_time, n_reads, n_batches = time_reader(original_read_batches, filename, batch_size, solid, repeat)
+        current_time = time_reader(current_read_batches, filename, batch_size, solid, repeat)[0]
+
+        print '%s: %s reads, %s batches' % (filename, pretty_number(n_reads), pretty_number(n_batches))
+        print '%-10s %10.3fs %12.0f reads/s' % ('original', original_time, n_reads/max(original_time,1e-9))
+        print '%-10s %10.3fs %12.0f reads/s' % ('current', current_time, n_reads/max(current_time,1e-9))
+        print '%.1fx speedup' % (original_time/max(current_time,1e-9))
+    return 0
+
+
+def make_pipeline_input(working_dir, n_pairs):
+    """ Synthetic reference and paired reads with substitutions,
+        the same every time. """
+
+    random.seed(0)
+    reference = ''.join([ random.choice('ACGT') for i in xrange(max(10000, n_pairs*2)) ])
+    f = open(os.path.join(working_dir,'reference.fa'),'wb')
+    f.write('>reference\n')
+    for i in xrange(0, len(reference), 60):
+        f.write(reference[i:i+60] + '\n')
+    f.close()
+
+    read_length = 36
+    f1 = open(os.path.join(working_dir,'reads_1.fq'),'wb')
+    f2 = open(os.path.join(working_dir,'reads_2.fq'),'wb')
+    for i in xrange(n_pairs):
+        start = random.randrange(len(reference) - 300)
+        sep = random.randrange(100, 200)
+        read_1 = list(reference[start:start+read_length])
+        read_2 = list(reverse_complement(reference[start+read_length+sep:start+read_length*2+sep]))
+        for read in (read_1, read_2):
+            for j in xrange(SEED_LENGTH, read_length):
+                if random.random() < 0.02:
+                    read[j] = random.choice('ACGT')
+        f1.write('@pair%d/1\n%s\n+\n%s\n' % (i, ''.join(read_1), 'I'*read_length))
+        f2.write('@pair%d/2\n%s\n+\n%s\n' % (i, ''.join(read_2), 'I'*read_length))
+    f1.close()
+    f2.close()
+
+
+def time_command(command):
+    start = time.time()
+    exit_status = subprocess.call(command, stdout=open(os.devnull,'wb'), stderr=open(os.devnull,'wb'))
+    elapsed = time.time() - start
+    assert exit_status == 0, 'Failed: ' + ' '.join(command)
+    return elapsed
+
+
+def benchmark_pipeline(working_dir, n_pairs, n_cpus):
+    if not os.path.isdir(working_dir):
+        os.mkdir(working_dir)
+    make_pipeline_input(working_dir, n_pairs)
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output_dir = os.path.join(working_dir, 'output')
+    run_time = time_command([ 
+        sys.executable, os.path.join(directory,'shrimp_run.py'), output_dir, 
+        os.path.join(working_dir,'reference.fa'), 
+        '--aligner', 'fake', '--cpus', str(n_cpus), '--paired', 
+        '--reads', os.path.join(working_dir,'reads_1.fq'), os.path.join(working_dir,'reads_2.fq') ])
+    consensus_time = time_command([ 
+        sys.executable, os.path.join(directory,'shrimp_consensus.py'), '--max-pair-sep', '500', output_dir ])
+
+    aligner_time = 0.0
+    for line in open(os.path.join(output_dir,'run_summary.txt'),'rb'):
+        if line.strip().endswith('seconds of SHRiMP time'):
+            aligner_time = float(line.split()[0])
+
+    n_reads = n_pairs * 2
+    print '%s reads, shrimp_run.py --cpus %d' % (pretty_number(n_reads), n_cpus)
+    print '%-20s %10.3fs %12.0f reads/s' % ('shrimp_run.py', run_time, n_reads/max(run_time,1e-9))
+    print '%-20s %10.3fs (summed over aligners)' % ('  fake aligner', aligner_time)
+    print '%-20s %10.3fs' % ('  other', max(0.0, run_time - aligner_time/n_cpus))
+    print '%-20s %10.3fs %12.0f reads/s' % ('shrimp_consensus.py', consensus_time, n_reads/max(consensus_time,1e-9))
+    return 0
+
+
+CHECK_PAIRS = 2000
+
+def load_seqset(output_dir):
+    seqset = shrimp_consensus.Refseqset()
+    for name, seq in shrimp_reads.read_reference(os.path.join(output_dir,'reference.fa')):
+        seqset.add_sequence(name, seq.upper())
+    seqset.read_shrimp(os.path.join(output_dir,'shrimp_hits.txt'))
+    return seqset
+
+def same_pileups(seqset_1, seqset_2):
+    for name in seqset_1.seqs:
+        pileup_1 = seqset_1.seqs[name].pileup()
+        pileup_2 = seqset_2.seqs[name].pileup()
+        for array_1, array_2 in zip(pileup_1[:3], pileup_2[:3]):
+            if not (array_1 == array_2).all(): return False
+        if pileup_1[3:] != pileup_2[3:]: return False
+    return True
+
+def check_shards(output_dir):
+    """ process_in_parallel with more shards than processes, 
+        so processes are reused, against process_hits and process_paired_hits. """
+    
+    trim = 0
+    infidelity = 1.0
+    for pair_options in (None, (500, 0, '/1', '/2')):
+        serial = load_seqset(output_dir)
+        if pair_options is None:
+            serial.process_hits(trim, infidelity)
+        else:
+            serial.process_paired_hits(*pair_options + (trim, infidelity))
+        
+        parallel = load_seqset(output_dir)
+        parallel.process_in_parallel(2, trim, infidelity, pair_options, 7)
+        
+        assert same_pileups(serial, parallel), \
+            'process_in_parallel differs from a single process (%s)' % (pair_options and 'paired' or 'unpaired')
+    print 'ok   shrimp_consensus.py shards'
+
+def check_variant(working_dir):
+    """ A substitution, insertion or deletion planted in reads from 
+        one strand, aligned by the fake aligner, is reported by 
+        shrimp_consensus.py. """
+    
+    directory = os.path.dirname(os.path.abspath(__file__))
+    random.seed(1)
+    reference = ''.join([ random.choice('ACGT') for i in xrange(2000) ])
+    position = 1000
+    new_base = random.choice([ base for base in 'ACGT' if base != reference[position] ])
+    inserted_base = random.choice([ base for base in 'ACGT' if base not in reference[position-1:position+1] ])
+    while reference[position] == reference[position+1]:
+        position += 1
+    
+    reference_filename = os.path.join(working_dir,'variant_reference.fa')
+    f = open(reference_filename,'wb')
+    f.write('>reference\n%s\n' % reference)
+    f.close()
+    
+    variants = [
+        ('substitution', reference[:position] + new_base + reference[position+1:],
+         [ 'reference', str(position+1), 'substitution', reference[position], new_base ]),
+        ('insertion', reference[:position] + inserted_base + reference[position:],
+         [ 'reference', str(position+1), 'insertion-before', '-', inserted_base ]),
+        ('deletion', reference[:position] + reference[position+1:],
+         [ 'reference', str(position+1), 'deletion', reference[position], '-' ]),
+    ]
+    
+    read_length = 36
+    for what, sample, expected in variants:
+        for strand in '+-':
+            reads_filename = os.path.join(working_dir,'variant_reads.fa')
+            f = open(reads_filename,'wb')
+            for start in xrange(0, len(sample)-read_length+1, 3):
+                read = sample[start:start+read_length]
+                if strand == '-':
+                    read = reverse_complement(read)
+                f.write('>read%d\n%s\n' % (start, read))
+            f.close()
+            
+            #Not resumed from an earlier run
+            output_dir = os.path.join(working_dir, 'variant_output')
+            if os.path.isdir(output_dir):
+                shutil.rmtree(output_dir)
+            time_command([ 
+                sys.executable, os.path.join(directory,'shrimp_run.py'), output_dir, 
+                reference_filename, '--aligner', 'fake', '--reads', reads_filename ])
+            time_command([ 
+                sys.executable, os.path.join(directory,'shrimp_consensus.py'), output_dir ])
+            
+            for edit_string, corresp_seq in load_edit_strings(output_dir, None):
+                assert shrimp_consensus.edit_string_to_alignment(edit_string, corresp_seq) == \
+                       original_edit_string_to_alignment(edit_string, corresp_seq), \
+                       'Decoders disagree on ' + edit_string
+            
+            report = [ line.rstrip('\n').split('\t')[:5] for line in open(os.path.join(output_dir,'report.txt'),'rb') ][1:]
+            assert report == [ expected ], \
+                '%s in %s strand reads reported as %s, expected %s' % (
+                    what, strand, report, expected)
+    print 'ok   fake aligner and shrimp_consensus.py substitution, insertion, deletion'
+
+def check_other_letters(working_dir):
+    """ An ambiguity code in the reference, matched by reads from
+        either strand, is counted as a letter and can be called. """
+    
+    directory = os.path.dirname(os.path.abspath(__file__))
+    random.seed(2)
+    reference = ''.join([ random.choice('ACGT') for i in xrange(2000) ])
+    position = 1000
+    reference = reference[:position] + 'R' + reference[position+1:]
+    
+    reference_filename = os.path.join(working_dir,'other_reference.fa')
+    f = open(reference_filename,'wb')
+    f.write('>reference\n%s\n' % reference)
+    f.close()
+    
+    read_length = 36
+    reads_filename = os.path.join(working_dir,'other_reads.fa')
+    f = open(reads_filename,'wb')
+    n_covering = 0
+    for start in xrange(0, len(reference)-read_length+1, 3):
+        read = reference[start:start+read_length]
+        if start % 2:
+            read = reverse_complement(read)
+        f.write('>read%d\n%s\n' % (start, read))
+        if start <= position < start+read_length:
+            n_covering += 1
+    f.close()
+    
+    output_dir = os.path.join(working_dir, 'other_output')
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    time_command([ 
+        sys.executable, os.path.join(directory,'shrimp_run.py'), output_dir, 
+        reference_filename, '--aligner', 'fake', '--reads', reads_filename ])
+    
+    for n_processes in (1, 2):
+        seqset = load_seqset(output_dir)
+        if n_processes == 1:
+            seqset.process_hits(0, 1.0)
+        else:
+            seqset.process_in_parallel(n_processes, 0, 1.0)
+        refseq = seqset.seqs['reference']
+        refseq.resolve_depths()
+        counts = refseq.substitution_counts(position)
+        assert counts == { 'R' : n_covering }, \
+            'Reference R at %d counted as %s' % (position+1, counts)
+        assert refseq.consensus(2, 0.5, False)[0][position] == 'R', \
+            'Reference R at %d not called' % (position+1)
+    print 'ok   shrimp_consensus.py letters other than ACGT-NX'
+
+def check(working_dir):
+    if not os.path.isdir(working_dir):
+        os.mkdir(working_dir)
+    make_pipeline_input(working_dir, CHECK_PAIRS)
+    
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output_dir = os.path.join(working_dir, 'output')
+    time_command([ 
+        sys.executable, os.path.join(directory,'shrimp_run.py'), output_dir, 
+        os.path.join(working_dir,'reference.fa'), '--aligner', 'fake', '--paired', 
+        '--reads', os.path.join(working_dir,'reads_1.fq'), os.path.join(working_dir,'reads_2.fq') ])
+    
+    check_shards(output_dir)
+    check_variant(working_dir)
+    check_other_letters(working_dir)
+    return 0
+
+
+def main(args):
+    limit, args = get_option_value(args, '--limit', int, None)
+    repeat, args = get_option_value(args, '--repeat', int, 3)
+    batch_size, args = get_option_value(args, '--batch-size', int, 30000000)
+    solid, args = get_flag(args, '--solid')
+    n_pairs, args = get_option_value(args, '--reads', int, 100000)
+    n_cpus, args = get_option_value(args, '--cpus', int, 2)
+
+    if len(args) == 3 and args[1] == 'edit-strings':
+        return benchmark_edit_strings(args[2], limit, repeat)
+
+    if len(args) >= 3 and args[1] == 'readers':
+        return benchmark_readers(args[2:], batch_size, solid, repeat)
+
+    if len(args) == 3 and args[1] == 'pipeline':
+        return benchmark_pipeline(args[2], n_pairs, n_cpus)
+
+    if len(args) == 3 and args[1] == 'check':
+        return check(args[2])
+
+    sys.stderr.write( USAGE )
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit( main(sys.argv) )
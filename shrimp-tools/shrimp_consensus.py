@@ -38,18 +38,50 @@ Changes:
 0.10 - Added option --ambiguity-codes
        Reads not following pair naming convention will no longer cause an error
 
+0.11 - index of read name -> hit locations is saved as shrimp_hits.txt.index
+       and reused on subsequent runs (memory-mapped rather than held in memory)
+
+0.12 - base counts held in an array rather than a dict per position,
+       insertions only stored for positions that have them
+       (as are counts of letters other than ACGT-NX, eg ambiguity codes 
+       copied from the reference)
+
+0.13 - consensus called for a whole sequence at once with numpy
+       (insertions are still called one position at a time)
+
+0.14 - added option --processes
+
+0.15 - added options --stream and --hits, to read hits in a single pass
+       (eg from a pipe or gzipped file)
+
+0.16 - faster decoding of edit strings
+
+0.17 - hits without insertions or deletions are added to counts directly,
+       without constructing an alignment
+
+0.18 - depths accumulated as changes at the start and end of each hit, 
+       and summed once all hits are processed
+
+0.19 - --stream can be used with --max-pair-sep, 
+       most efficient with hits from shrimp_run.py --paired
+
+0.20 - reference read via mmap using the .fai index written by 
+       shrimp_run.py, rather than parsed with Biopython
+
 Note: Python's garbage collection means allocation is O(n^2) (still true as at Python 2.6.1)
       and is disabled in this script
       (this still leaves reference counting, so there should not be leaks)
 
 """
 
-VERSION = '0.10'
+VERSION = '0.20'
 
 
-import sys, os, numpy, heapq, string, math
+import sys, os, re, numpy, heapq, string, math, struct, hashlib, multiprocessing
 from Bio import Seq, SeqRecord, SeqIO, Alphabet
 
+import shrimp_reads
+
 
 USAGE = """\
 
@@ -61,6 +93,15 @@ to use SOLiD read name suffixes and directions (the defaults
 work with Illumina paired end). You will still need to specify 
 "--max-pair-sep NNN" to enable paired-end processing. 
 
+  --stream
+
+to read the hits file once, in order, rather than indexing it. 
+This requires all hits for each read to be adjacent, as written 
+by shrimp_run.py. The hits may then come from a gzipped file or
+from standard input (--hits -). With --max-pair-sep, reads are 
+held in memory until their pair is seen, so use shrimp_run.py --paired 
+to place the hits of each pair together.
+
 Usage: 
 
   shrimp_consensus.py [options] working_dir
@@ -72,9 +113,12 @@ where working_dir was created by shrimp_run.py.
 class Error(Exception): 
     pass
 
+SHOW_STATUS = True
+
 def status(string):
     """ Display a status string. """
     
+    if not SHOW_STATUS: return
     sys.stderr.write('\r\x1b[K' + string)
     sys.stderr.flush()
 
@@ -103,56 +147,96 @@ def open_possibly_compressed_file(filename):
     else:
         return open(filename,'rb')
     
+EDIT_STRING_TOKEN = re.compile(r'\(([^)]*)\)|([0-9]+)|(-+)|(.)')
+
+MATCH, INSERTION, DELETION, SUBSTITUTION = range(4)
+
+# edit string -> [ (token type, value) ]
+# Most reads share a small number of edit strings (eg "36")
+EDIT_STRING_CACHE = { }
+EDIT_STRING_CACHE_SIZE = 100000
+
+def tokenize_edit_string(edit_string):
+    """ Split an edit string as output by SHRiMP and ELAND into
+        [ (token type, value) ]. """
+
+    tokens = [ ]
+    for gap, n_matches, deleted, substitution in EDIT_STRING_TOKEN.findall(edit_string):
+        if gap:
+            tokens.append((INSERTION, gap.upper()))
+        elif n_matches:
+            tokens.append((MATCH, int(n_matches)))
+        elif deleted:
+            tokens.append((DELETION, len(deleted)))
+        else:
+            tokens.append((SUBSTITUTION, substitution.upper()))
+    return tokens
+
 def edit_string_to_alignment(edit_string, corresp_seq):
     """ Convert an edit string as output by SHRiMP and ELAND to
         a conventional alignment. """
 
-    len_edit_string = len(edit_string)
-    read_ali = ''
-    contig_ali = ''
-    i = 0    
-    while i < len_edit_string:
-        if edit_string[i] == '(':
-            j = i + 1
-            while edit_string[j] != ')': j += 1
-            gap = edit_string[i+1:j].upper()
-            
-            #print 'insertion', gap
-            read_ali += gap
-            contig_ali += '-' * len(gap)
-            
-            i = j + 1
-        elif edit_string[i].isdigit():
-            j = i
-            while j < len_edit_string and edit_string[j].isdigit(): j += 1
-            n_matches = int(edit_string[i:j].upper())
-
-            #print 'match', n_matches            
-            read_ali += corresp_seq[:n_matches]
-            contig_ali += corresp_seq[:n_matches]
-            corresp_seq = corresp_seq[n_matches:]
-
-            i = j            
-        elif edit_string[i] == '-':
-            #print 'deletion'
-            j = i
-            while j < len_edit_string and edit_string[j] == '-': j += 1
-            
-            n_deleted = j-i
-            contig_ali += corresp_seq[:n_deleted]
-            read_ali += '-' * n_deleted
-            corresp_seq = corresp_seq[n_deleted:]
-        
-            i = j
+    tokens = EDIT_STRING_CACHE.get(edit_string)
+    if tokens is None:
+        if len(EDIT_STRING_CACHE) >= EDIT_STRING_CACHE_SIZE:
+            EDIT_STRING_CACHE.clear()
+        tokens = EDIT_STRING_CACHE[edit_string] = tokenize_edit_string(edit_string)
+
+    if len(tokens) == 1 and tokens[0][0] == MATCH:
+        matched = corresp_seq[:tokens[0][1]]
+        return matched, matched
+
+    read_ali = [ ]
+    contig_ali = [ ]
+    position = 0
+    for token_type, value in tokens:
+        if token_type == MATCH:
+            matched = corresp_seq[position:position+value]
+            read_ali.append(matched)
+            contig_ali.append(matched)
+            position += value
+        elif token_type == SUBSTITUTION:
+            contig_ali.append(corresp_seq[position:position+1])
+            read_ali.append(value)
+            position += 1
+        elif token_type == INSERTION:
+            read_ali.append(value)
+            contig_ali.append('-' * len(value))
         else:
-            #print 'substitution', edit_string[i]
-            contig_ali += corresp_seq[:1]
-            read_ali += edit_string[i].upper()
-            corresp_seq = corresp_seq[1:]
-            
-            i += 1
+            contig_ali.append(corresp_seq[position:position+value])
+            read_ali.append('-' * value)
+            position += value
+
+    return ''.join(contig_ali), ''.join(read_ali)
 
-    return contig_ali, read_ali
+# edit string -> None if it has insertions or deletions, 
+#                otherwise (length, [ (offset, substituted base) ])
+SUBSTITUTIONS_CACHE = { }
+
+def edit_string_substitutions(edit_string):
+    """ If an edit string contains only matches and substitutions,
+        its length and the substitutions in it. Otherwise None. """
+    
+    try:
+        return SUBSTITUTIONS_CACHE[edit_string]
+    except KeyError:
+        pass
+    
+    result = (0, [ ])
+    for token_type, value in tokenize_edit_string(edit_string):
+        if token_type == MATCH:
+            result = (result[0] + value, result[1])
+        elif token_type == SUBSTITUTION:
+            result[1].append((result[0], value))
+            result = (result[0] + 1, result[1])
+        else:
+            result = None
+            break
+    
+    if len(SUBSTITUTIONS_CACHE) >= EDIT_STRING_CACHE_SIZE:
+        SUBSTITUTIONS_CACHE.clear()
+    SUBSTITUTIONS_CACHE[edit_string] = result
+    return result
 
 def roll_alignment(ali, ali_other):
     """ Normalize one half of an alignment by shifting "-"s as far right as possible.
@@ -226,6 +310,28 @@ AMBIGUITY_DECODE = { }
 for decode in AMBIGUITY_CODES:
     AMBIGUITY_DECODE[ AMBIGUITY_CODES[decode] ] = decode
 
+# Columns of Refseq.base_counts
+# N also counts X (a shrimp colorspace confuzzle) and anything else unexpected,
+# it is not used in calling the consensus
+# (letters other than N and X are also counted individually in Refseq.other_counts)
+BASES = 'ACGT-N'
+N_BASES_CALLED = 5
+BASE_INDEX = { }
+for i, base in enumerate(BASES):
+    BASE_INDEX[base] = i
+N_INDEX = BASE_INDEX['N']
+
+# Letter -> column of Refseq.base_counts
+BASE_COLUMN = numpy.empty(256, 'int8')
+BASE_COLUMN[:] = N_INDEX
+for base in BASES:
+    BASE_COLUMN[ ord(base) ] = BASE_INDEX[base]
+
+# Letter -> whether it is counted in Refseq.other_counts
+OTHER_LETTER = numpy.ones(256, 'bool')
+for base in BASES + 'X':
+    OTHER_LETTER[ ord(base) ] = False
+
 def ambiguity_code_consensus(counts, min_depth,min_purity):
     """ Call a consensus, if it meets minimum depth and purity 
         (proportion of total) requirements. 
@@ -263,6 +369,77 @@ def ambiguity_code_consensus(counts, min_depth,min_purity):
     
     return AMBIGUITY_CODES.get(bases, None)
 
+
+# Bit masks of sets of BASES -> consensus letter, 'N' if no consensus
+CALL_TABLE = numpy.empty(1<<N_BASES_CALLED, 'S1')
+CALL_TABLE[:] = 'N'
+for decode in AMBIGUITY_CODES:
+    CALL_TABLE[ sum([ 1<<BASE_INDEX[base] for base in decode ]) ] = AMBIGUITY_CODES[decode]
+
+# consensus() breaks ties by the order items come out of a dict,
+# the last of equal counts winning. Replicate that.
+TIE_ORDER = numpy.array([ 
+    BASE_INDEX[base] for base, count in dict.fromkeys(BASES[:N_BASES_CALLED],0).items() 
+][::-1])
+
+# Letter -> bit mask of BASES it may represent
+LETTER_MASK = numpy.zeros(256, 'int64')
+for decode in AMBIGUITY_CODES:
+    LETTER_MASK[ ord(AMBIGUITY_CODES[decode]) ] = sum([ 1<<BASE_INDEX[base] for base in decode ])
+
+# Reference letter -> bit mask, only for the letters themselves (not ambiguity codes)
+REFERENCE_MASK = numpy.zeros(256, 'int64')
+for base in BASES[:N_BASES_CALLED]:
+    REFERENCE_MASK[ ord(base) ] = 1<<BASE_INDEX[base]
+
+def consensus_array(base_counts, min_depth,min_purity,use_ambiguity_codes):
+    """ Vectorized equivalent of consensus() or ambiguity_code_consensus()
+        applied to each row of base_counts (columns as in BASES).
+        
+        Returns an array of consensus letters, 'N' where there is no consensus.
+        
+        """
+    
+    counts = numpy.asarray(base_counts[:,:N_BASES_CALLED], 'int64')
+    total = numpy.sum(counts,1)
+    rows = numpy.arange(len(counts))
+    
+    if use_ambiguity_codes:
+        # Accumulate counts from largest to smallest until purity and depth
+        # are satisfied, then include every base with at least the count reached
+        ordered = -numpy.sort(-counts,1)
+        accumulated = numpy.cumsum(ordered,1)
+        satisfied = (accumulated >= min_depth) & (accumulated >= min_purity * total[:,None])
+        cutoff = ordered[rows, numpy.argmax(satisfied,1)]
+        included = (counts >= cutoff[:,None]) & (counts > 0)
+        mask = numpy.sum(included << numpy.arange(N_BASES_CALLED), 1)
+        mask[ ~numpy.any(satisfied,1) ] = 0
+    else:
+        winner = TIE_ORDER[ numpy.argmax(counts[:,TIE_ORDER],1) ]
+        best = counts[rows, winner]
+        mask = 1 << winner
+        mask[ (best < min_depth) | (best < min_purity * total) ] = 0
+    
+    mask[ total == 0 ] = 0
+    return CALL_TABLE[mask]
+
+
+def splice(letters, keep, insertions):
+    """ Join an array of letters into a string, dropping those not in keep 
+        (if given), and inserting [ (position, sequence) ] before the given
+        positions. """
+    
+    pieces = [ ]
+    start = 0
+    for position, sequence in insertions + [ (len(letters), '') ]:
+        if keep is None:
+            pieces.append(letters[start:position].tostring())
+        else:
+            pieces.append(letters[start:position][keep[start:position]].tostring())
+        pieces.append(sequence)
+        start = position
+    return ''.join(pieces)
+
 def entropy(counts):
     total = sum(counts.values())
     result = 0.0
@@ -345,13 +522,256 @@ def pretty_evidence(counts):
 
 def _hit_score(hit): return hit.score
 
+
+def hit_line_read_name(line):
+    return line[:line.index('\t')].split()[0]
+
+def read_hit_groups(lines):
+    """ Group consecutive lines of a SHRiMP hit file by read name.
+        
+        Yields (read_name, [ line ]). """
+    
+    read_name = None
+    group = [ ]
+    for line in lines:
+        if line.startswith('#'): continue
+        
+        line_read_name = hit_line_read_name(line)
+        if line_read_name != read_name:
+            if group: 
+                yield read_name, group
+            read_name = line_read_name
+            group = [ ]
+        group.append(line)
+    
+    if group:
+        yield read_name, group
+
+def read_name_hash(read_name):
+    """ Stable 64-bit hash of a read name. """
+    return struct.unpack('<Q', hashlib.md5(read_name).digest()[:8])[0]
+
+INDEX_MAGIC = 'SHRiMPi1'
+INDEX_HEADER = '<8sqdqq' # magic, hit file size, hit file mtime, n hits, n reads
+INDEX_HEADER_SIZE = 64
+INDEX_CHUNK = 1<<20
+
+class Hit_index(object):
+    """ Index of the locations of each read's hits in a SHRiMP hit file.
+
+        Acts like a read-only { read_name : [ file offset ] } dict. It is saved
+        alongside the hit file (filename + '.index') and memory-mapped when
+        re-used, so it is only built once and never held in memory as Python
+        objects. Different read names may share a hash, so names are checked
+        against the hit file itself.
+
+        Properties:
+
+            hashes  - hash of the read name of each hit, sorted
+            offsets - file offset of each hit, in the same order as hashes
+            starts  - index into hashes of the first hit of each read,
+                      in order of appearance in the hit file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '.index'
+        self.reopen()
+
+        stat = os.stat(filename)
+        if not self._load(stat.st_size, stat.st_mtime):
+            self._build()
+            self._save(stat.st_size, stat.st_mtime)
+
+    def _load(self, size, mtime):
+        if not os.path.exists(self.index_filename):
+            return False
+
+        f = open(self.index_filename,'rb')
+        header = f.read(INDEX_HEADER_SIZE)
+        f.close()
+        if len(header) != INDEX_HEADER_SIZE:
+            return False
+
+        magic, index_size, index_mtime, n_hits, n_reads = \
+            struct.unpack(INDEX_HEADER, header[:struct.calcsize(INDEX_HEADER)])
+        if magic != INDEX_MAGIC or index_size != size or index_mtime != mtime:
+            return False
+
+        if os.path.getsize(self.index_filename) != INDEX_HEADER_SIZE + 16*n_hits + 8*n_reads:
+            return False
+
+        if not n_hits:
+            self.hashes = numpy.zeros(0, '<u8')
+            self.offsets = numpy.zeros(0, '<i8')
+            self.starts = numpy.zeros(0, '<i8')
+            return True
+
+        self.hashes = numpy.memmap(self.index_filename, '<u8', 'r',
+                                   INDEX_HEADER_SIZE, (n_hits,))
+        self.offsets = numpy.memmap(self.index_filename, '<i8', 'r',
+                                    INDEX_HEADER_SIZE + 8*n_hits, (n_hits,))
+        self.starts = numpy.memmap(self.index_filename, '<i8', 'r',
+                                   INDEX_HEADER_SIZE + 16*n_hits, (n_reads,))
+        return True
+
+    def _build(self):
+        hash_chunks = [ ]
+        offset_chunks = [ ]
+        hashes = [ ]
+        offsets = [ ]
+
+        n = 0
+        f = open(self.filename,'rb')
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line: break
+
+            if line.startswith('#'): continue
+
+            n += 1
+            if n % 10000 == 0:
+                status('Indexing hit %s of %s' % (pretty_number(n), self.filename))
+
+            hashes.append(read_name_hash(hit_line_read_name(line)))
+            offsets.append(position)
+
+            if len(hashes) >= INDEX_CHUNK:
+                hash_chunks.append(numpy.array(hashes, '<u8'))
+                offset_chunks.append(numpy.array(offsets, '<i8'))
+                hashes = [ ]
+                offsets = [ ]
+        f.close()
+
+        hash_chunks.append(numpy.array(hashes, '<u8'))
+        offset_chunks.append(numpy.array(offsets, '<i8'))
+        del hashes, offsets
+
+        hashes = numpy.concatenate(hash_chunks)
+        del hash_chunks
+        offsets = numpy.concatenate(offset_chunks)
+        del offset_chunks
+
+        status('Sorting index of ' + self.filename)
+
+        #Stable sort, so offsets remain in file order within each read
+        order = numpy.argsort(hashes, kind='mergesort')
+        self.hashes = hashes[order]
+        del hashes
+        self.offsets = offsets[order]
+        del offsets, order
+
+        if len(self.hashes):
+            is_start = numpy.empty(len(self.hashes), bool)
+            is_start[0] = True
+            is_start[1:] = self.hashes[1:] != self.hashes[:-1]
+            starts = numpy.flatnonzero(is_start)
+            del is_start
+        else:
+            starts = numpy.zeros(0, '<i8')
+        self.starts = starts[numpy.argsort(self.offsets[starts])].astype('<i8')
+
+        status('')
+
+    def _save(self, size, mtime):
+        temp_filename = self.index_filename + '.temp%d' % os.getpid()
+        try:
+            f = open(temp_filename,'wb')
+            header = struct.pack(INDEX_HEADER,
+                INDEX_MAGIC, size, mtime, len(self.hashes), len(self.starts))
+            f.write(header + '\0' * (INDEX_HEADER_SIZE-len(header)))
+            self.hashes.tofile(f)
+            self.offsets.tofile(f)
+            self.starts.tofile(f)
+            f.close()
+            os.rename(temp_filename, self.index_filename)
+        except (IOError, OSError), e:
+            sys.stderr.write('\n*** WARNING: could not save hit index %s (%s) ***\n\n' % (self.index_filename, e))
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+
+    def reopen(self):
+        """ Open the hit file afresh (eg in a child process, 
+            which would otherwise share the file position). """
+        
+        self.file = open(self.filename,'rb')
+
+    def _read_name_at(self, offset):
+        self.file.seek(offset)
+        return hit_line_read_name(self.file.readline())
+
+    def _range(self, read_name):
+        key = numpy.uint64(read_name_hash(read_name))
+        return (self.hashes.searchsorted(key, 'left'),
+                self.hashes.searchsorted(key, 'right'))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, read_name):
+        start, end = self._range(read_name)
+        for offset in self.offsets[start:end]:
+            if self._read_name_at(int(offset)) == read_name:
+                return True
+        return False
+
+    def __getitem__(self, read_name):
+        """ Offsets of hits to read_name (may include hits to other reads
+            with the same hash). """
+
+        start, end = self._range(read_name)
+        if start == end:
+            raise KeyError(read_name)
+        return [ int(offset) for offset in self.offsets[start:end] ]
+
+    def __iter__(self):
+        return self._iter_read_names(self.starts)
+
+    def shard(self, i, n):
+        """ The i-th of n contiguous portions of the reads. """
+        
+        return Hit_index_shard(self, len(self.starts)*i//n, len(self.starts)*(i+1)//n)
+
+    def _iter_read_names(self, starts):
+        hashes = self.hashes
+        offsets = self.offsets
+        for start in starts:
+            end = hashes.searchsorted(hashes[start], 'right')
+            if end == start+1:
+                yield self._read_name_at(int(offsets[start]))
+            else:
+                names = [ ]
+                for offset in offsets[start:end]:
+                    read_name = self._read_name_at(int(offset))
+                    if read_name not in names:
+                        names.append(read_name)
+                for read_name in names:
+                    yield read_name
+
+
+class Hit_index_shard(object):
+    """ Read names from a contiguous portion of a Hit_index, in file order. """
+    
+    def __init__(self, index, begin, end):
+        self.index = index
+        self.begin = begin
+        self.end = end
+    
+    def __len__(self):
+        return self.end - self.begin
+    
+    def __iter__(self):
+        return self.index._iter_read_names(self.index.starts[self.begin:self.end])
+
+
 class Refseqset(object):
     """ A collection of reference seqeunces.
     
         Properties:
     
             seqs - { name : Refseq }
-            hits - { read_name : [ Hit ] }
+            hits - Hit_index, { read_name : [ file offset ] }
 
     """
 
@@ -365,36 +785,22 @@ class Refseqset(object):
         
         self.seqs[name] = Refseq(name, sequence)
 
+    def reopen(self):
+        self.shrimp_file = open(self.hits.filename,'rb')
+        self.hits.reopen()
+
     def read_shrimp(self, filename, warn_about_paired_end=False):
         assert self.shrimp_file is None
         self.shrimp_file = open(filename,'rb')
-        
-        n = 0        
-        while True:
-            position = self.shrimp_file.tell()
-            line = self.shrimp_file.readline()
-            if not line: break
-            
-            if line.startswith('#'): continue
-            
-            n += 1
-            if n % 10000 == 0:
-                status('Scanning hit %s of %s' % (pretty_number(n), filename))
-            
-            read_name = line[:line.index('\t')].split()[0]
-            if read_name not in self.hits: 
-                self.hits[read_name] = [ ]
-            self.hits[read_name].append(position)
-            
-            if warn_about_paired_end and \
-               (read_name[-3:] in ('_F3','_R3') or
-                read_name[-2:] in ('/1','/2')):
-                status('')
-                
-                sys.stderr.write('\n*** WARNING: read names look like paired end, but no --max-pair-sep given ***\n\n')
-                warn_about_paired_end = False 
-                
-        status('')
+        self.hits = Hit_index(filename)
+
+        if warn_about_paired_end:
+            for i, read_name in enumerate(self.hits):
+                if i >= 100: break
+                if read_name[-3:] in ('_F3','_R3') or \
+                   read_name[-2:] in ('/1','/2'):
+                    sys.stderr.write('\n*** WARNING: read names look like paired end, but no --max-pair-sep given ***\n\n')
+                    break
 
     def get_hits(self, read_name):
         result = [ ]
@@ -402,47 +808,41 @@ class Refseqset(object):
             self.shrimp_file.seek(position)
             line = self.shrimp_file.readline()
             
-            (read_name, contig_name, strand, 
-             contig_start, contig_end, 
-             read_start, read_end, read_length, 
-             score, edit_string) = line.rstrip().split('\t')
-
-            hit = Hit()
-        
-            hit.read_name = read_name.split()[0]
-            hit.ref_name = contig_name.split()[0]
-            hit.ref_start = int(contig_start)-1
-            hit.ref_end = int(contig_end)
-            hit.read_start = int(read_start)-1
-            hit.read_end = int(read_end)
-            hit.read_length = int(read_length)
-            hit.score = int(score)
-            hit.forward = (strand == '+')
-            
-            assert hit.read_name == read_name
-            
-            #if not read_name.endswith('/1') and not read_name.endswith('/2'):
-            #    print repr(line)
+            #Another read with the same hash
+            if hit_line_read_name(line) != read_name: continue
             
-            corresp_seq = self.seqs[hit.ref_name].reference[hit.ref_start:hit.ref_end]
-    
-            if not hit.forward:
-                corresp_seq = reverse_complement(corresp_seq)
-
-            hit.ref_ali, hit.read_ali = edit_string_to_alignment(edit_string, corresp_seq)	    
-            
-            if not hit.forward:
-                hit.ref_ali = reverse_complement(hit.ref_ali)
-                hit.read_ali = reverse_complement(hit.read_ali)
-
-            #Normalization -- move "-"s as far right as possible
-            hit.read_ali = roll_alignment(hit.read_ali, hit.ref_ali)
-            hit.ref_ali = roll_alignment(hit.ref_ali, hit.read_ali)
-            
-            result.append(hit)
+            result.append(self.parse_hit(line))
                 
         return result
 
+    def parse_hit(self, line):
+        """ Hit from a line of a SHRiMP hit file. """
+        
+        (read_name, contig_name, strand, 
+         contig_start, contig_end, 
+         read_start, read_end, read_length, 
+         score, edit_string) = line.rstrip().split('\t')
+
+        hit = Hit()
+    
+        hit.read_name = read_name.split()[0]
+        hit.ref_name = contig_name.split()[0]
+        hit.ref_start = int(contig_start)-1
+        hit.ref_end = int(contig_end)
+        hit.read_start = int(read_start)-1
+        hit.read_end = int(read_end)
+        hit.read_length = int(read_length)
+        hit.score = int(score)
+        hit.forward = (strand == '+')
+        
+        hit.edit_string = edit_string
+        
+        #Alignment is only constructed if needed, see Refseq.align_hit
+        hit.ref_ali = None
+        hit.read_ali = None
+        
+        return hit
+
     def process_hits(self, trim, infidelity, read_names=None):
         """ Update counts in Refseq objects based on hits read in. """
         
@@ -457,37 +857,56 @@ class Refseqset(object):
                 status('Processing read %s of %s' % (pretty_number(i), pretty_number(len(read_names))))
         
             #hits = self.hits[read_name]
-            hits = self.get_hits(read_name)
-            hits.sort(key=_hit_score, reverse=True)
+            self.process_read_hits(self.get_hits(read_name), trim, infidelity)
+
+        status('')
+
+    def process_hit_stream(self, hit_file, trim, infidelity):
+        """ Update counts in Refseq objects based on hits read sequentially 
+            from hit_file, in which each read's hits must be adjacent. 
             
-            n = 1
-            while n < len(hits) and hits[n].score >= hits[0].score*infidelity:
-                n += 1
-                
-            if n == 1:
-                self.seqs[ hits[0].ref_name ].process_unambiguous_hit(hits[0], trim)
+            self.hits is not used. """
+        
+        for i, (read_name, lines) in enumerate(read_hit_groups(hit_file)):
+            if (i % 10000) == 0:
+                status('Processing read %s' % pretty_number(i))
             
-            for hit in hits[:n]:
-                self.seqs[ hit.ref_name ].process_hit(hit, n, trim)
-
+            self.process_read_hits([ self.parse_hit(line) for line in lines ], trim, infidelity)
+        
         status('')
     
-    def process_paired_hits(self, max_pair_sep, same_direction, suffix1, suffix2, trim, infidelity):
-        """ Update counts in Refseq objects based on hits read in. """
+    def process_read_hits(self, hits, trim, infidelity):
+        """ Update counts in Refseq objects based on all hits to a read. """
         
-        n_total = 0
-        n_valid_total = 0        
-        n_valid_unambiguous = 0
-        unambiguous_seps = [ ]
+        hits.sort(key=_hit_score, reverse=True)
+        
+        n = 1
+        while n < len(hits) and hits[n].score >= hits[0].score*infidelity:
+            n += 1
+            
+        if n == 1:
+            self.seqs[ hits[0].ref_name ].process_unambiguous_hit(hits[0], trim)
+        
+        for hit in hits[:n]:
+            self.seqs[ hit.ref_name ].process_hit(hit, n, trim)
+    
+    def process_paired_hits(self, max_pair_sep, same_direction, suffix1, suffix2, trim, infidelity, read_names=None):
+        """ Update counts in Refseq objects based on hits read in. 
         
+            Returns pair statistics (see pair_stats_text) and weird pair report. """
+        
+        if read_names is None: 
+            read_names = self.hits
+        
+        pair_stats = [ 0, 0, 0, [ ], 0, 0 ]
         weird_pair_report = [ ]
         
         orphans = [ ]
         unpaired = [ ]
         
-        for i, read_name_1 in enumerate(self.hits):
+        for i, read_name_1 in enumerate(read_names):
             if (i % 10000) == 0:
-                status('Processing reads as pairs %s of %s' % (pretty_number(i), pretty_number(len(self.hits))))
+                status('Processing reads as pairs %s of %s' % (pretty_number(i), pretty_number(len(read_names))))
                 
             if read_name_1.endswith(suffix2): 
                 read_name_2 = read_name_1[:len(read_name_1)-len(suffix2)] + suffix1
@@ -507,101 +926,241 @@ class Refseqset(object):
                 orphans.append(read_name_1)
                 continue
             
-            n_total += 1
-            
             #hits_1 = self.hits[read_name_1]
-            hits_1 = self.get_hits(read_name_1)
-            hits_1.sort(key=_hit_score, reverse=True)
             #hits_2 = self.hits[read_name_2]
-            hits_2 = self.get_hits(read_name_2)
-            hits_2.sort(key=_hit_score, reverse=True)
-            
-            pair_iter = Hit_pair_iter(hits_1,hits_2)
+            self.process_read_pair(self.get_hits(read_name_1), self.get_hits(read_name_2),
+                                   max_pair_sep, same_direction, trim, infidelity, 
+                                   pair_stats, weird_pair_report)
+
+        status('')
+        
+        self.process_hits(trim, infidelity, orphans + unpaired)
+        
+        pair_stats[4] = len(orphans)
+        pair_stats[5] = len(unpaired)
+        return pair_stats, weird_pair_report
+
+    def process_paired_hit_stream(self, hit_file, max_pair_sep, same_direction, suffix1, suffix2, trim, infidelity):
+        """ process_paired_hits, reading hits sequentially from hit_file
+            (see process_hit_stream). 
             
-            top_hits = [ ]
-            for score, pos_1, pos_2 in pair_iter:
-                if top_hits and score < top_hits[0][0]*infidelity: break
-                
-                hit_1 = hits_1[pos_1]
-                hit_2 = hits_2[pos_2]
-                
-                if hit_1.ref_name != hit_2.ref_name:
-                    continue
-                
-                if same_direction:
-                    if hit_1.forward != hit_2.forward: continue
-                else:
-                    if hit_1.forward == hit_2.forward: continue
-                    
-                if hit_1.forward:
-                    sep = hit_2.ref_start - hit_1.ref_end
-                else:
-                    sep = hit_1.ref_start - hit_2.ref_end
-                
-                if sep > max_pair_sep or sep < 0:
-                    continue
-                
-                top_hits.append((score, hit_1, hit_2))
+            Reads are held until their pair turns up, so this is most 
+            efficient if the hits of each pair are adjacent, 
+            as produced by shrimp_run.py --paired. """
+        
+        pair_stats = [ 0, 0, 0, [ ], 0, 0 ]
+        weird_pair_report = [ ]
+        
+        waiting = { }
+        
+        for i, (read_name, lines) in enumerate(read_hit_groups(hit_file)):
+            if (i % 10000) == 0:
+                status('Processing reads as pairs %s' % pretty_number(i))
             
-            if not top_hits:
-                if (len(hits_1) == 1 or hits_1[0].score*infidelity > hits_1[1].score) and \
-                   (len(hits_2) == 1 or hits_2[0].score*infidelity > hits_2[1].score):
-                    hit_1 = hits_1[0]
-                    hit_2 = hits_2[0]
-                    if hit_1.forward:
-                        hit_1_end = hit_1.ref_end
-                    else:
-                        hit_1_end = hit_1.ref_start
-                    if hit_2.forward:
-                        hit_2_end = hit_2.ref_end
-                    else:
-                        hit_2_end = hit_2.ref_start
-                    #out by one error above?
-                    
-                    weird_pair_report.append((hit_1.ref_name, hit_1.forward, hit_1_end, hit_2.ref_name, hit_2.forward, hit_2_end))
+            hits = [ self.parse_hit(line) for line in lines ]
             
+            if read_name.endswith(suffix1):
+                key = (read_name[:len(read_name)-len(suffix1)], suffix2)
+                mate_key = (key[0], suffix1)
+            elif read_name.endswith(suffix2):
+                key = (read_name[:len(read_name)-len(suffix2)], suffix1)
+                mate_key = (key[0], suffix2)
+            else:
+                pair_stats[5] += 1
+                self.process_read_hits(hits, trim, infidelity)
                 continue
             
-            n_valid_total += 1
+            if key not in waiting:
+                waiting[mate_key] = hits
+                continue
             
-            if len(top_hits) == 1:
-                n_valid_unambiguous += 1
+            mate_hits = waiting.pop(key)
+            if mate_key[1] == suffix1:
+                hits_1, hits_2 = hits, mate_hits
+            else:
+                hits_1, hits_2 = mate_hits, hits
+            self.process_read_pair(hits_1, hits_2, max_pair_sep, same_direction, trim, infidelity, 
+                                   pair_stats, weird_pair_report)
+        
+        status('')
+        
+        for hits in waiting.values():
+            pair_stats[4] += 1
+            self.process_read_hits(hits, trim, infidelity)
+        
+        return pair_stats, weird_pair_report
 
-                hit_1 = top_hits[0][1]
-                hit_2 = top_hits[0][2]
+    def process_read_pair(self, hits_1, hits_2, max_pair_sep, same_direction, trim, infidelity, 
+                          pair_stats, weird_pair_report):
+        """ Update counts in Refseq objects based on all hits to a read pair.
+        
+            Updates pair_stats and weird_pair_report. """
+            
+        pair_stats[0] += 1
+        
+        hits_1.sort(key=_hit_score, reverse=True)
+        hits_2.sort(key=_hit_score, reverse=True)
+        
+        pair_iter = Hit_pair_iter(hits_1,hits_2)
+        
+        top_hits = [ ]
+        for score, pos_1, pos_2 in pair_iter:
+            if top_hits and score < top_hits[0][0]*infidelity: break
+            
+            hit_1 = hits_1[pos_1]
+            hit_2 = hits_2[pos_2]
+            
+            if hit_1.ref_name != hit_2.ref_name:
+                continue
+            
+            if same_direction:
+                if hit_1.forward != hit_2.forward: continue
+            else:
+                if hit_1.forward == hit_2.forward: continue
+                
+            if hit_1.forward:
+                sep = hit_2.ref_start - hit_1.ref_end
+            else:
+                sep = hit_1.ref_start - hit_2.ref_end
+            
+            if sep > max_pair_sep or sep < 0:
+                continue
+            
+            top_hits.append((score, hit_1, hit_2))
+        
+        if not top_hits:
+            if (len(hits_1) == 1 or hits_1[0].score*infidelity > hits_1[1].score) and \
+               (len(hits_2) == 1 or hits_2[0].score*infidelity > hits_2[1].score):
+                hit_1 = hits_1[0]
+                hit_2 = hits_2[0]
                 if hit_1.forward:
-                    sep = hit_2.ref_start - hit_1.ref_end
+                    hit_1_end = hit_1.ref_end
                 else:
-                    sep = hit_1.ref_start - hit_2.ref_end
-                unambiguous_seps.append(sep)
+                    hit_1_end = hit_1.ref_start
+                if hit_2.forward:
+                    hit_2_end = hit_2.ref_end
+                else:
+                    hit_2_end = hit_2.ref_start
+                #out by one error above?
                 
-                self.seqs[ hit_1.ref_name ].process_unambiguous_hit( hit_1, trim )
-                self.seqs[ hit_2.ref_name ].process_unambiguous_hit( hit_2, trim )
+                weird_pair_report.append((hit_1.ref_name, hit_1.forward, hit_1_end, hit_2.ref_name, hit_2.forward, hit_2_end))
+        
+            return
+        
+        pair_stats[1] += 1
         
-            for neg_score, hit_1, hit_2 in top_hits:
-                self.seqs[ hit_1.ref_name ].process_hit(hit_1, len(top_hits), trim)
-                self.seqs[ hit_2.ref_name ].process_hit(hit_2, len(top_hits), trim)
+        if len(top_hits) == 1:
+            pair_stats[2] += 1
 
-        status('')
+            hit_1 = top_hits[0][1]
+            hit_2 = top_hits[0][2]
+            if hit_1.forward:
+                sep = hit_2.ref_start - hit_1.ref_end
+            else:
+                sep = hit_1.ref_start - hit_2.ref_end
+            pair_stats[3].append(sep)
+            
+            self.seqs[ hit_1.ref_name ].process_unambiguous_hit( hit_1, trim )
+            self.seqs[ hit_2.ref_name ].process_unambiguous_hit( hit_2, trim )
+    
+        for neg_score, hit_1, hit_2 in top_hits:
+            self.seqs[ hit_1.ref_name ].process_hit(hit_1, len(top_hits), trim)
+            self.seqs[ hit_2.ref_name ].process_hit(hit_2, len(top_hits), trim)
+
+    def process_in_parallel(self, n_processes, trim, infidelity, pair_options=None, n_shards=None):
+        """ process_hits or process_paired_hits (if pair_options given),
+            with reads divided into n_shards shards (default: n_processes)
+            processed by n_processes processes. 
+            
+            Each shard's counts are accumulated separately, then summed. """
         
-        self.process_hits(trim, infidelity, orphans + unpaired)
+        global WORKER_SEQSET
+        WORKER_SEQSET = self
         
-        stats_text = (        
-           pretty_number(n_total,20) + ' read pairs where both reads hit something\n' +
-           pretty_number(n_valid_total,20) + ' read pairs validly oriented and spaced\n' +
-           pretty_number(n_valid_unambiguous,20) + ' unambiguously\n'
-        )
+        pool = multiprocessing.Pool(n_processes)
         
-        if unambiguous_seps:
-            stats_text += pretty_number(int(numpy.median(unambiguous_seps)),20) + \
-                          ' median separation of paired reads (limit %d)\n' % max_pair_sep
-
-        stats_text += '\n' + pretty_number(len(orphans),20) + ' reads with no hits to their pair\n'
+        pair_stats = [ 0, 0, 0, [ ], 0, 0 ]
+        weird_pair_report = [ ]
+        
+        status('Processing reads in %d processes' % n_processes)
+        
+        if n_shards is None:
+            n_shards = n_processes
+        jobs = [ (i, n_shards, trim, infidelity, pair_options) for i in xrange(n_shards) ]
+        for i, (pileups, shard_pair_stats, shard_weird_pair_report) in \
+                enumerate(pool.imap(_process_shard, jobs)):
+            status('Processing reads in %d processes, %d of %d shards finished' % (n_processes, i+1, n_shards))
+            
+            for name in pileups:
+                self.seqs[name].add_pileup(pileups[name])
+            
+            if shard_pair_stats is not None:
+                for j in xrange(len(pair_stats)):
+                    pair_stats[j] += shard_pair_stats[j]
+                weird_pair_report.extend(shard_weird_pair_report)
         
-        if unpaired:
-            stats_text += '\n' + pretty_number(len(unpaired),20) + ' without a read-pair suffix, treated as single reads\n'
+        pool.close()
+        pool.join()
+        WORKER_SEQSET = None
         
-        return stats_text, weird_pair_report
+        status('')
+        
+        if pair_options is None:
+            return None
+        return pair_stats, weird_pair_report
+
+
+WORKER_SEQSET = None
+
+def _process_shard(job):
+    """ Run in a child process of Refseqset.process_in_parallel. """
+
+    i, n, trim, infidelity, pair_options = job
+
+    global SHOW_STATUS
+    SHOW_STATUS = False
+    
+    seqset = WORKER_SEQSET
+    seqset.reopen()
+    
+    #A worker may process several shards, return only this one's counts
+    for name in seqset.seqs:
+        seqset.seqs[name].reset_pileup()
+    
+    read_names = seqset.hits.shard(i, n)
+    
+    if pair_options is None:
+        seqset.process_hits(trim, infidelity, read_names)
+        pair_stats = weird_pair_report = None
+    else:
+        pair_stats, weird_pair_report = \
+            seqset.process_paired_hits(*pair_options + (trim, infidelity, read_names))
+    
+    pileups = { }
+    for name in seqset.seqs:
+        pileups[name] = seqset.seqs[name].pileup()
+    return pileups, pair_stats, weird_pair_report
+
+
+def pair_stats_text(pair_stats, max_pair_sep):
+    n_total, n_valid_total, n_valid_unambiguous, unambiguous_seps, n_orphans, n_unpaired = pair_stats
+    
+    stats_text = (        
+       pretty_number(n_total,20) + ' read pairs where both reads hit something\n' +
+       pretty_number(n_valid_total,20) + ' read pairs validly oriented and spaced\n' +
+       pretty_number(n_valid_unambiguous,20) + ' unambiguously\n'
+    )
+    
+    if unambiguous_seps:
+        stats_text += pretty_number(int(numpy.median(unambiguous_seps)),20) + \
+                      ' median separation of paired reads (limit %d)\n' % max_pair_sep
+
+    stats_text += '\n' + pretty_number(n_orphans,20) + ' reads with no hits to their pair\n'
+    
+    if n_unpaired:
+        stats_text += '\n' + pretty_number(n_unpaired,20) + ' without a read-pair suffix, treated as single reads\n'
+    
+    return stats_text
 
 class Hit(object):
     """ Structure to store hits """
@@ -618,9 +1177,14 @@ class Hit(object):
         'read_end',
         'read_ali',
         'read_length',
+        'edit_string',
     )
 
     
+# Ambiguous depth is accumulated in fixed point, in units of 1/AMBIGUOUS_DEPTH_UNIT,
+# so that changes cancel exactly. This is exact for hits that are one of up to 16.
+AMBIGUOUS_DEPTH_UNIT = 720720
+
 class Refseq(object):
     """ Reference sequence and statistics on alignments thereto.
     
@@ -631,9 +1195,20 @@ class Refseq(object):
         
             depth - unambiguous hit depth
             depth_ambiguous - estimated true depth
+            (both only valid after resolve_depths)
+            
+            depth_changes - change in depth at each position, 
+                            accumulated while processing hits
+            depth_ambiguous_changes - likewise for depth_ambiguous, 
+                                      in units of 1/AMBIGUOUS_DEPTH_UNIT
         
-            base_counts - { letter : count } (includes deletions as '-')
-            insertions - { position : [ sequence ] }
+            base_counts - array of counts, position x letter in BASES
+                          (includes deletions as '-')
+            other_counts - { position : { letter : count } }
+                           for letters not in BASES, other than X
+                           (only positions with such letters)
+            insertions - { position : { sequence : count } }
+                         (only positions with insertions)
                 
     """
 
@@ -644,6 +1219,9 @@ class Refseq(object):
         self.depth = numpy.zeros(len(self.reference), 'int')
         self.depth_ambiguous = numpy.zeros(len(self.reference), 'float')
         
+        self.depth_changes = numpy.zeros(len(self.reference)+1, 'int64')
+        self.depth_ambiguous_changes = numpy.zeros(len(self.reference)+1, 'int64')
+        
         #self.incomplete_ends_count = numpy.zeros(len(self.reference), 'int')
         #self.bias = numpy.zeros(len(self.reference), 'float')
 
@@ -651,12 +1229,40 @@ class Refseq(object):
         #for base in 'ACGT-':
         #    self.base_counts[base] = numpy.zeros(len(self.reference), 'int')
             
-        #self.insertions = { } # index *after* insertion -> { inserted sequence : count }
+        self.base_counts = numpy.zeros((len(self.reference), len(BASES)), 'int32')
+        self.other_counts = { }
+        reference_letters = numpy.frombuffer(self.reference, 'uint8')
+        self.reference_columns = BASE_COLUMN[ reference_letters ]
+        self.reference_others = numpy.flatnonzero(OTHER_LETTER[ reference_letters ])
+        self.insertions = { } # index *after* insertion -> { inserted sequence : count }
+
+    def align_hit(self, hit):
+        """ Construct hit.ref_ali and hit.read_ali. """
+        
+        corresp_seq = self.reference[hit.ref_start:hit.ref_end]
+
+        if not hit.forward:
+            corresp_seq = reverse_complement(corresp_seq)
+
+        hit.ref_ali, hit.read_ali = edit_string_to_alignment(hit.edit_string, corresp_seq)
         
-        self.base_counts = [ {} for i in xrange(len(reference)) ]
-        self.insertions = [ {} for i in xrange(len(reference)) ]
+        if not hit.forward:
+            hit.ref_ali = reverse_complement(hit.ref_ali)
+            hit.read_ali = reverse_complement(hit.read_ali)
+
+        #Normalization -- move "-"s as far right as possible
+        hit.read_ali = roll_alignment(hit.read_ali, hit.ref_ali)
+        hit.ref_ali = roll_alignment(hit.ref_ali, hit.read_ali)
 
     def process_unambiguous_hit(self, hit, trim):
+        substitutions = edit_string_substitutions(hit.edit_string)
+        if substitutions is not None and substitutions[0] == hit.ref_end-hit.ref_start:
+            self.process_substitutions_only_hit(hit, substitutions[1], trim)
+            return
+        
+        if hit.ref_ali is None:
+            self.align_hit(hit)
+        
         #self.depth[hit.ref_start:hit.ref_end] += 1
         
         #if hit.read_start > trim:
@@ -682,6 +1288,9 @@ class Refseq(object):
                 position += 1
             i += 1
 
+        first_position = position
+        columns = [ ]
+
         #scaler = 1.0/(len(hit.ref_ali)-1.0)
         while i < len_hit_ref_ali-trim:
             if hit_ref_ali[i] == '-':
@@ -689,28 +1298,145 @@ class Refseq(object):
                 while j < len_hit_ref_ali and hit_ref_ali[j] == '-': j += 1
                 what = hit_read_ali[i:j]
                 
-                #if position not in self.insertions: self.insertions[position] = { }
-                counter = self.insertions[position]
+                counter = self.insertions.get(position)
+                if counter is None:
+                    counter = self.insertions[position] = { }
                 counter[what] = counter.get(what,0) + 1
                 
                 i = j	        
             else:
-                if hit_read_ali[i] not in 'NX': #X is a shrimp colorspace confuzzle
-                    #self.base_counts[ hit_read_ali[i] ][position] += 1
-                    counter = self.base_counts[position]
-                    base = hit_read_ali[i]
-                    counter[base] = counter.get(base,0)+1
-                self.depth[position] += 1
+                column = BASE_INDEX.get(hit_read_ali[i], N_INDEX)
+                if column == N_INDEX and hit_read_ali[i] not in 'NX':
+                    self.count_other(position, hit_read_ali[i], 1)
+                columns.append(column)
                 
                 #self.bias[position] += i*scaler - 0.5 
                 
                 position += 1        
                 i += 1
+
+        # Positions are consecutive, so update counts in one go
+        if columns:
+            self.depth_changes[first_position] += 1
+            self.depth_changes[position] -= 1
+            self.base_counts[numpy.arange(first_position,position), columns] += 1
+
+    def process_substitutions_only_hit(self, hit, substitutions, trim):
+        """ process_unambiguous_hit for a hit with no insertions or deletions,
+            straight from its substitutions (as from edit_string_substitutions). """
+        
+        start = hit.ref_start + trim
+        end = hit.ref_end - trim
+        if start >= end: return
+        
+        self.depth_changes[start] += 1
+        self.depth_changes[end] -= 1
+        self.base_counts[numpy.arange(start,end), self.reference_columns[start:end]] += 1
+        
+        if len(self.reference_others):
+            first, last = numpy.searchsorted(self.reference_others, [start, end])
+            for position in self.reference_others[first:last]:
+                self.count_other(int(position), self.reference[position], 1)
+        
+        for offset, base in substitutions:
+            if hit.forward:
+                position = hit.ref_start + offset
+            else:
+                position = hit.ref_end - 1 - offset
+                base = base.translate(COMPLEMENTER)
+            
+            if position < start or position >= end: continue
+            
+            self.base_counts[position, self.reference_columns[position]] -= 1
+            self.base_counts[position, BASE_INDEX.get(base, N_INDEX)] += 1
+            if OTHER_LETTER[ ord(self.reference[position]) ]:
+                self.count_other(position, self.reference[position], -1)
+            if OTHER_LETTER[ ord(base) ]:
+                self.count_other(position, base, 1)
+
+    def count_other(self, position, letter, change):
+        """ Change the count in other_counts of a letter at a position. """
+        
+        counter = self.other_counts.get(position)
+        if counter is None:
+            counter = self.other_counts[position] = { }
+        count = counter.get(letter,0) + change
+        if count:
+            counter[letter] = count
+        else:
+            del counter[letter]
+            if not counter:
+                del self.other_counts[position]
+
+    def pileup(self):
+        """ Counts accumulated so far, in a form that can be passed to add_pileup. """
+        
+        return self.depth_changes, self.depth_ambiguous_changes, self.base_counts, self.insertions, self.other_counts
+    
+    def reset_pileup(self):
+        """ Discard the counts accumulated so far. """
+        
+        self.depth_changes[:] = 0
+        self.depth_ambiguous_changes[:] = 0
+        self.base_counts[:] = 0
+        self.insertions = { }
+        self.other_counts = { }
+    
+    def add_pileup(self, pileup):
+        """ Add counts from another Refseq's pileup() of the same reference. """
+        
+        depth_changes, depth_ambiguous_changes, base_counts, insertions, other_counts = pileup
+        self.depth_changes += depth_changes
+        self.depth_ambiguous_changes += depth_ambiguous_changes
+        self.base_counts += base_counts
+        for position in insertions:
+            counter = self.insertions.get(position)
+            if counter is None:
+                counter = self.insertions[position] = { }
+            for what, count in insertions[position].items():
+                counter[what] = counter.get(what,0) + count
+        for position in other_counts:
+            for letter, count in other_counts[position].items():
+                self.count_other(position, letter, count)
+
+    def insertion_counts(self, i):
+        """ { inserted sequence : count } immediately before position i,
+            absence of an insertion is counted as '-'. """
+
+        insertions = self.insertions.get(i)
+        if insertions:
+            insertions = insertions.copy()
+        else:
+            insertions = { }
+        total = sum(insertions.values())
+        depth = self.depth[i]
+        if i: depth = min(depth, self.depth[i-1])
+        if depth > total: insertions['-'] = int(depth-total)
+        return insertions
+
+    def substitution_counts(self, i):
+        """ { letter : count } at position i (includes deletions as '-') """
+
+        counts = { }
+        row = self.base_counts[i]
+        for j in xrange(N_BASES_CALLED):
+            if row[j]:
+                counts[BASES[j]] = int(row[j]) #Typecast to strip weird slow printing numpy type
+        counts.update(self.other_counts.get(i, { }))
+        return counts
     
     def process_hit(self, hit, one_of_n, trim):
         #TODO: don't ignore trim!
         #self.depth_ambiguous[hit.ref_start:hit.ref_end] += 1.0 / one_of_n
-        self.depth_ambiguous[hit.ref_start:hit.ref_end] = self.depth_ambiguous[hit.ref_start:hit.ref_end] + 1.0 / one_of_n
+        weight = (AMBIGUOUS_DEPTH_UNIT + one_of_n//2) // one_of_n
+        self.depth_ambiguous_changes[hit.ref_start] += weight
+        self.depth_ambiguous_changes[hit.ref_end] -= weight
+
+    def resolve_depths(self):
+        """ Calculate depth and depth_ambiguous from the changes accumulated. """
+        
+        self.depth = numpy.cumsum(self.depth_changes[:-1])
+        self.depth_ambiguous = numpy.cumsum(self.depth_ambiguous_changes[:-1]) / float(AMBIGUOUS_DEPTH_UNIT)
 
     def consensus(self, min_depth,min_purity,use_ambiguity_codes):
         """ 
@@ -718,96 +1444,76 @@ class Refseq(object):
           consensus sequence        
           snp/indel report        
           For each position in the reference, whether there was a consensus        
+
+        Evidence for each position is available from
+        insertion_counts and substitution_counts.
         """
     
-        result = [ ]
-        result_masked_only = [ ]
-        
-        alignment_result    = [ ]
-        alignment_reference = [ ]
-        
-        insertion_evidence = [ ]
-        substitution_evidence = [ ]
-        
-        has_consensus = [ ]
-        
         status('Consensus %s' % self.name)
         
-        report = [ ]
+        reference = numpy.frombuffer(self.reference, 'S1')
         
-        for i in xrange(len(self.reference)):
-            if i % 10000 == 0:
-                status('Consensus %s %s' % (self.name, pretty_number(i)))
-            #if i in self.insertions:
+        # Insertions, only need to look at positions where they occurred
+        inserted = [ ]
+        report = [ ]
+        for i in sorted(self.insertions):
             # Need to count absense of insertions in consensus
-            #if i in self.insertions:
-            #insertions = self.insertions.get(i,{}).copy()
-            insertions = self.insertions[i]
-            total = sum(insertions.values())
-            #else:
-            #    insertions = { }
-            #    total = 0
-            depth = self.depth[i]
-            if i: depth = min(depth, self.depth[i-1])
-            if depth > total: insertions['-'] = depth-total
+            insertions = self.insertion_counts(i)
                 
             #c = consensus(insertions, min_depth,min_purity)
             c = consensus(insertions, min_depth,0.0)
             if c is not None and c != '-': 
-                result.append(c)
-                result_masked_only.append(c)
-                report.append(('insertion-before', i, '-', c, insertions))
-                
-                alignment_result.append(c)
-                alignment_reference.append('-' * len(c))
-            
-            insertion_evidence.append(insertions)
-            
-            
-            
-            #counts = { }
-            #for base in self.base_counts:
-            #    if self.base_counts[base][i]: 
-            #        counts[base] = int(self.base_counts[base][i]) #Typecast to strip weird slow printing numpy type
-            counts = self.base_counts[i]
-            
+                inserted.append((i, c))
+                report.append((i, 0, ('insertion-before', i, '-', c, insertions)))
+        
+        # Substitutions and deletions
+        called = consensus_array(self.base_counts, min_depth,min_purity,use_ambiguity_codes)
+        
+        # Positions with other letters are called one at a time, 
+        # with those letters as alleles in their own right
+        for i in self.other_counts:
             if use_ambiguity_codes:
-                c = ambiguity_code_consensus(counts, min_depth,min_purity)
+                c = ambiguity_code_consensus(self.substitution_counts(i), min_depth,min_purity)
             else:
-                c = consensus(counts, min_depth,min_purity)
-            
-            if c is None:
-                result.append('N')
-                result_masked_only.append( self.reference[i].lower() )
-                has_consensus.append(False)
-            elif c == '-':
-                report.append(('deletion',i, self.reference[i], '-', counts))
-                has_consensus.append(True)
+                c = consensus(self.substitution_counts(i), min_depth,min_purity)
+            called[i] = c or 'N'
+        
+        no_call = called == 'N'
+        deleted = called == '-'
+        not_deleted = ~deleted
+        
+        called_mask = LETTER_MASK[ called.view('uint8') ]
+        has_consensus = (called_mask == 1) | (called_mask == 2) | (called_mask == 4) | \
+                        (called_mask == 8) | deleted #Exclude ambiguity codes
+        
+        #if c != self.reference[i]:
+        substituted = ~no_call & not_deleted & \
+                      (called_mask & REFERENCE_MASK[ reference.view('uint8') ] == 0)
+        
+        for i in numpy.flatnonzero(deleted | substituted):
+            i = int(i)
+            if deleted[i]:
+                report.append((i, 1, ('deletion',i, self.reference[i], '-', self.substitution_counts(i))))
             else:
-                result.append(c)
-                result_masked_only.append(c)
-                has_consensus.append(c in 'ACGT') #Exclude ambiguity codes
-                
-                #if c != self.reference[i]:
-                if self.reference[i] not in AMBIGUITY_DECODE[c]:
-                    report.append(('substitution', i, self.reference[i], c, counts))
-                    
-            substitution_evidence.append(counts)
-            alignment_result.append(c or 'N')
-            alignment_reference.append(self.reference[i])
-            
+                report.append((i, 1, ('substitution', i, self.reference[i], called[i], self.substitution_counts(i))))
+        
+        report.sort()
+        report = [ item[2] for item in report ]
+        
+        result = splice(called, not_deleted, inserted)
+        result_masked_only = splice(numpy.where(no_call, numpy.char.lower(reference), called), not_deleted, inserted)
+        alignment_result = splice(called, None, inserted)
+        alignment_reference = splice(reference, None, [ (i, '-' * len(c)) for i, c in inserted ])
         
         status('')
         
         return (
-            ''.join(result),
-            ''.join(result_masked_only), 
+            result,
+            result_masked_only, 
             report, 
             has_consensus, 
-            insertion_evidence, 
-            substitution_evidence,
-            ''.join(alignment_reference), 
-            ''.join(alignment_result)
+            alignment_reference, 
+            alignment_result
         )
 
 
@@ -885,6 +1591,9 @@ def main(args):
     trim, args = get_option_value(args,'--trim', int, 0)
     infidelity, args = get_option_value(args,'--infidelity', float, 1.0)
     use_ambiguity_codes, args = get_option_value(args,'--ambiguity-codes', int, 1)
+    n_processes, args = get_option_value(args,'--processes', int, 1)
+    stream, args = get_flag(args,'--stream')
+    shrimp_filename, args = get_option_value(args,'--hits', str, None)
     
     max_pair_sep, args = get_option_value(args, '--max-pair-sep', int, None)
     suffix1, args = get_option_value(args, '--suffix1', str, suffix1)
@@ -908,6 +1617,10 @@ def main(args):
         ['','',                               ' proportion of the best hit\'s score)'],
         ['--ambiguity-codes', '%d' % use_ambiguity_codes, '(use IUPAC ambiguity codes.'],
         ['','',                                     ' 0-no just use Ns, 1-yes)'],
+        ['--processes', '%d' % n_processes, '(number of processes to use)'],
+        ['--stream', '%d' % stream, '(read hits in a single pass, 0-no 1-yes)'],
+        ['--hits', shrimp_filename or 'default', '(hits file, - for standard input,'],
+        ['','',                                  ' default is working_dir/shrimp_hits.txt)'],
         ['','',''],
         ['--max-pair-sep', max_pair_sep_text, '(maximum distance between paired ends,'],
         ['', '', ' will treat reads as unpaired if not given)'],
@@ -945,16 +1658,27 @@ def main(args):
     #    #shrimp_filenames = [ os.path.join(output_dir,'shrimp_hits.txt.gz') ]
     #    shrimp_filenames = [ os.path.join(output_dir,'shrimp_hits.txt') ]
     
-    shrimp_filename = os.path.join(output_dir,'shrimp_hits.txt')
+    if shrimp_filename is None:
+        shrimp_filename = os.path.join(output_dir,'shrimp_hits.txt')
+        
+        if not os.path.exists(shrimp_filename) and \
+           os.path.exists(os.path.join(output_dir,'shrimp_hits.txt.gz')):
+            if not stream:
+                sys.stderr.write('shrimp_hits.txt.gz is no longer compressed,\n')
+                sys.stderr.write('  you need to gunzip it, use --stream, or re-run shrimp_run.py\n')
+                return 1
+            shrimp_filename = os.path.join(output_dir,'shrimp_hits.txt.gz')
+    
+    if not stream and (shrimp_filename == '-' or shrimp_filename.endswith('.gz')):
+        sys.stderr.write('Hits from standard input or a gzipped file require --stream\n')
+        return 1
     
-    if not os.path.exists(shrimp_filename) and \
-       os.path.exists(os.path.join(output_dir,'shrimp_hits.txt.gz')):
-        sys.stderr.write('shrimp_hits.txt.gz is no longer compressed,\n')
-        sys.stderr.write('  you need to gunzip it or re-run shrimp_run.py\n')
+    if stream and n_processes > 1:
+        sys.stderr.write('--stream can not be used with --processes\n')
         return 1
         
     for filename in [reference_filename, shrimp_filename]:
-        assert os.path.exists(filename), filename + ' does not exist'
+        assert filename == '-' or os.path.exists(filename), filename + ' does not exist'
     
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
@@ -962,18 +1686,40 @@ def main(args):
     seqset = Refseqset()
     
     seq_order = [ ]
-    for record in SeqIO.parse(open(reference_filename,'rU'), 'fasta'):
-        seqset.add_sequence(record.id, record.seq.tostring().upper())
-        seq_order.append(record.id)
-
-    seqset.read_shrimp(shrimp_filename, max_pair_sep is None)
+    for name, seq in shrimp_reads.read_reference(reference_filename):
+        seqset.add_sequence(name, seq.upper())
+        seq_order.append(name)
 
-    if max_pair_sep is None:
-        seqset.process_hits(trim, infidelity)
+    if stream:
+        if shrimp_filename == '-':
+            hit_file = sys.stdin
+        else:
+            hit_file = open_possibly_compressed_file(shrimp_filename)
+    
+    if stream and max_pair_sep is None:
+        seqset.process_hit_stream(hit_file, trim, infidelity)
+        hit_file.close()
+    elif max_pair_sep is None:
+        seqset.read_shrimp(shrimp_filename, True)
+        if n_processes > 1:
+            seqset.process_in_parallel(n_processes, trim, infidelity)
+        else:
+            seqset.process_hits(trim, infidelity)
     else:
-        stats_text, weird_pair_report = \
-            seqset.process_paired_hits(
-                max_pair_sep, same_direction, suffix1, suffix2, trim, infidelity)
+        pair_options = (max_pair_sep, same_direction, suffix1, suffix2)
+        if stream:
+            pair_stats, weird_pair_report = \
+                seqset.process_paired_hit_stream(hit_file, *pair_options + (trim, infidelity))
+            hit_file.close()
+        elif n_processes > 1:
+            seqset.read_shrimp(shrimp_filename)
+            pair_stats, weird_pair_report = \
+                seqset.process_in_parallel(n_processes, trim, infidelity, pair_options)
+        else:
+            seqset.read_shrimp(shrimp_filename)
+            pair_stats, weird_pair_report = \
+                seqset.process_paired_hits(*pair_options + (trim, infidelity))
+        stats_text = pair_stats_text(pair_stats, max_pair_sep)
 
         stats_file = open(os.path.join(output_dir, 'pair_stats.txt'), 'wb')
         stats_file.write( stats_text )
@@ -989,6 +1735,9 @@ def main(args):
             ))
         weird_pair_file.close()
         
+    for name in seq_order:
+        seqset.seqs[name].resolve_depths()
+        
     consensus_file = open(os.path.join(output_dir, 'consensus.fa'), 'wb')
     consensus_masked_file = open(os.path.join(output_dir, 'consensus_masked.fa'), 'wb')
     reference_having_consensus_file = open(os.path.join(output_dir, 'reference_having_consensus.fa'), 'wb')
@@ -1002,9 +1751,10 @@ def main(args):
     alignment_file.write( '#shrimp_consensus.py %s\n' % VERSION )
     
     for name in seq_order:
-        consensus, consensus_masked_only, report, has_consensus, insertion_evidence, \
-        substitution_evidence, alignment_reference, alignment_result = \
-            seqset.seqs[name].consensus(min_depth,min_purity,use_ambiguity_codes)
+        refseq = seqset.seqs[name]
+        consensus, consensus_masked_only, report, has_consensus, \
+        alignment_reference, alignment_result = \
+            refseq.consensus(min_depth,min_purity,use_ambiguity_codes)
         
         status('Write results for ' + name)
             
@@ -1021,7 +1771,7 @@ def main(args):
         #SeqIO.write([record], has_consensus_file, 'fasta')
 
         ref = seqset.seqs[name].reference
-        seq = Seq.Seq(''.join([ item and ref[i] or 'n' for i, item in enumerate(has_consensus) ]))
+        seq = Seq.Seq(numpy.where(has_consensus, numpy.frombuffer(ref,'S1'), 'n').tostring())
         record = SeqRecord.SeqRecord( seq, id=name, description='' )
         SeqIO.write([record], reference_having_consensus_file, 'fasta')
         
@@ -1074,12 +1824,12 @@ def main(args):
             
         f = open(os.path.join(output_dir, filesystem_friendly_name(name) + '-evidence.txt'),'wb')
         f.write( 'Position\tInsertion-before evidence\tSubstitution evidence\tReference\n' )
-        for i in xrange(len(insertion_evidence)):
+        for i in xrange(len(refseq.reference)):
             f.write( '%d\t%s\t%s\t%s\n' % (
                 i+1,
-                pretty_evidence(insertion_evidence[i]),
-                pretty_evidence(substitution_evidence[i]),
-                seqset.seqs[name].reference[i]
+                pretty_evidence(refseq.insertion_counts(i)),
+                pretty_evidence(refseq.substitution_counts(i)),
+                refseq.reference[i]
             ))
         
         status('Write unambiguous depth for ' + name)
@@ -1109,10 +1859,10 @@ def main(args):
         #f.close()
         #
         #f = open(os.path.join(output_dir, filesystem_friendly_name(name) + '-entropy.userplot'),'wb')
-        #for i in xrange(len(substitution_evidence)):
+        #for i in xrange(len(refseq.reference)):
         #    f.write( '%.1f\n' % (
-        #        entropy(substitution_evidence[i]) +
-        #        entropy(insertion_evidence[i])
+        #        entropy(refseq.substitution_counts(i)) +
+        #        entropy(refseq.insertion_counts(i))
         #    ))
         #f.close()
         
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+"""
+
+Read files for the SHRiMP tools: FASTA, FASTQ and SOLiD CSFASTA,
+possibly gzipped.
+
+Files are read in large chunks and split into records a chunk at a
+time, rather than calling readline() for every line.
+
+Gzipped files (including bgzip files) are decompressed by pigz if it
+is installed, otherwise by zlib in a background thread, so decompression
+overlaps with parsing.
+
+0.1 - initial version, split out of shrimp_run.py
+
+0.2 - reading pairs of files in step, keeping read pairs in the same batch
+
+0.3 - batch size may be chosen batch by batch, bytes_read() to track progress
+
+0.4 - reference preparation, with a .fai index and an optional cache 
+      of prepared references, and reading prepared references via mmap
+
+"""
+
+VERSION = '0.4'
+
+import os, gzip, itertools, threading, Queue, subprocess, hashlib, mmap, socket, shutil, numpy
+
+CHUNK_SIZE = 1 << 22
+
+
+def which(program):
+    """ Full path of program if it is on the PATH, otherwise None. """
+
+    for directory in os.environ.get('PATH','').split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def open_possibly_compressed_file(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename,'rb')
+    else:
+        return open(filename,'rb')
+
+
+RAW_FILES = [ ]
+RAW_BYTES_CLOSED = [ 0 ]
+RAW_LOCK = threading.Lock()
+
+def _open_raw(filename):
+    f = open(filename,'rb')
+    RAW_LOCK.acquire()
+    try:
+        RAW_FILES.append(f)
+    finally:
+        RAW_LOCK.release()
+    return f
+
+def _close_raw(f):
+    RAW_LOCK.acquire()
+    try:
+        RAW_BYTES_CLOSED[0] += os.lseek(f.fileno(), 0, os.SEEK_CUR)
+        RAW_FILES.remove(f)
+        f.close()
+    finally:
+        RAW_LOCK.release()
+
+def bytes_read():
+    """ Total bytes read so far (before decompression) from files 
+        opened by read_chunks. """
+    
+    RAW_LOCK.acquire()
+    try:
+        total = RAW_BYTES_CLOSED[0]
+        for f in RAW_FILES:
+            total += os.lseek(f.fileno(), 0, os.SEEK_CUR)
+    finally:
+        RAW_LOCK.release()
+    return total
+
+
+def _chunks_from_file(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk: break
+        yield chunk
+
+def _chunks_from_raw(filename):
+    raw = _open_raw(filename)
+    try:
+        for chunk in _chunks_from_file(raw):
+            yield chunk
+    finally:
+        _close_raw(raw)
+
+def _chunks_from_pigz(filename):
+    #pigz shares the file position, so bytes_read() sees its progress
+    raw = _open_raw(filename)
+    process = subprocess.Popen([ 'pigz', '-dc' ], stdin=raw, stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+    try:
+        for chunk in _chunks_from_file(process.stdout):
+            yield chunk
+    finally:
+        process.stdout.close()
+        exit_status = process.wait()
+        _close_raw(raw)
+    assert exit_status == 0, 'pigz failed to decompress ' + filename
+
+def _chunks_from_thread(filename):
+    chunk_queue = Queue.Queue(4)
+    raw = _open_raw(filename)
+
+    def decompress():
+        try:
+            f = gzip.GzipFile(fileobj=raw, mode='rb')
+            for chunk in _chunks_from_file(f):
+                chunk_queue.put(chunk)
+            f.close()
+            chunk_queue.put(None)
+        except Exception, e:
+            chunk_queue.put(e)
+        _close_raw(raw)
+
+    thread = threading.Thread(target=decompress)
+    thread.setDaemon(True)
+    thread.start()
+
+    while True:
+        chunk = chunk_queue.get()
+        if chunk is None: break
+        if isinstance(chunk, Exception): raise chunk
+        yield chunk
+
+def read_chunks(filename):
+    """ Yield the (decompressed) contents of a file in large chunks. """
+
+    if not filename.endswith('.gz'):
+        return _chunks_from_raw(filename)
+    elif which('pigz'):
+        return _chunks_from_pigz(filename)
+    else:
+        return _chunks_from_thread(filename)
+
+
+def read_line_blocks(chunks):
+    """ Yield lists of complete lines, newlines removed,
+        from an iterator of chunks. """
+
+    leftover = ''
+    for chunk in chunks:
+        end = chunk.rfind('\n') + 1
+        if not end:
+            leftover += chunk
+            continue
+        text = leftover + chunk[:end-1]
+        leftover = chunk[end:]
+        if '\r' in text:
+            text = text.replace('\r','')
+        yield text.split('\n')
+
+    if leftover.rstrip('\r\n'):
+        yield [ leftover.rstrip('\r\n') ]
+
+
+def _fastq_blocks(chunks):
+    pending = [ ]
+    for lines in read_line_blocks(chunks):
+        if pending:
+            lines = pending + lines
+        n = len(lines) - len(lines) % 4
+        pending = lines[n:]
+        if not n: continue
+
+        assert lines[0].startswith('@'), 'Not an Illumina FASTQ file?'
+        assert lines[2].startswith('+'), 'Not an Illumina FASTQ file?'
+        yield [ name[1:] for name in lines[0:n:4] ], lines[1:n:4]
+
+    assert not [ line for line in pending if line ], 'Truncated FASTQ file?'
+
+def _solid_blocks(chunks):
+    pending = [ ]
+    for lines in read_line_blocks(chunks):
+        if pending:
+            lines = pending + lines
+        if lines and lines[0].startswith('#'):
+            lines = [ line for line in lines if not line.startswith('#') ]
+        n = len(lines) - len(lines) % 2
+        pending = lines[n:]
+        if not n: continue
+
+        assert lines[0].startswith('>'), 'Not a SOLiD CSFASTA file?'
+        yield [ name[1:] for name in lines[0:n:2] ], lines[1:n:2]
+
+def _fasta_blocks(chunks):
+    #Pieces of the text not yet split, only joined once a record 
+    #starts in a new chunk, so a long record is not copied repeatedly
+    pieces = [ ]
+    for chunk in chunks:
+        start = chunk.rfind('\n>') + 1
+        if not start:
+            if not (chunk.startswith('>') and pieces and pieces[-1].endswith('\n')):
+                pieces.append(chunk)
+                continue
+        pieces.append(chunk[:start])
+        block = ''.join(pieces)
+        pieces = [ chunk[start:] ]
+        if block: yield _split_fasta(block)
+
+    leftover = ''.join(pieces)
+    if leftover.strip():
+        yield _split_fasta(leftover)
+
+def _split_fasta(text):
+    if '\r' in text:
+        text = text.replace('\r','')
+    assert text.startswith('>'), 'Not a FASTA file?'
+    names = [ ]
+    seqs = [ ]
+    for record in text[1:].split('\n>'):
+        parts = record.split('\n',1)
+        names.append(parts[0].split()[0])
+        if len(parts) == 1:
+            seqs.append('')
+        else:
+            seqs.append(''.join(parts[1].split()))
+    return names, seqs
+
+
+def read_blocks(filename, solid=False):
+    """ Yield ([read_name], [read_seq]) a chunk of the file at a time.
+        Format is SOLiD CSFASTA if solid, otherwise FASTA or FASTQ
+        detected from the first character of the file. """
+
+    chunks = read_chunks(filename)
+    if solid:
+        return _solid_blocks(chunks)
+
+    peeked = [ ]
+    for chunk in chunks:
+        peeked.append(chunk)
+        if chunk.lstrip(): break
+    chunks = itertools.chain(peeked, chunks)
+
+    if ''.join(peeked).lstrip().startswith('>'):
+        return _fasta_blocks(chunks)
+    else:
+        return _fastq_blocks(chunks)
+
+
+def read_paired_blocks(filename1, filename2, solid=False):
+    """ Yield ([read_name], [read_seq]) from two files of paired reads
+        read in step, alternating a read from the first file 
+        with its pair from the second file. """
+    
+    blocks_2 = read_blocks(filename2, solid)
+    names_1 = [ ]
+    seqs_1 = [ ]
+    names_2 = [ ]
+    seqs_2 = [ ]
+    for more_names, more_seqs in read_blocks(filename1, solid):
+        names_1.extend(more_names)
+        seqs_1.extend(more_seqs)
+        for more_names, more_seqs in blocks_2:
+            names_2.extend(more_names)
+            seqs_2.extend(more_seqs)
+            if len(names_2) >= len(names_1): break
+        
+        n = min(len(names_1), len(names_2))
+        names = [ None ] * (n*2)
+        names[0::2] = names_1[:n]
+        names[1::2] = names_2[:n]
+        seqs = [ None ] * (n*2)
+        seqs[0::2] = seqs_1[:n]
+        seqs[1::2] = seqs_2[:n]
+        del names_1[:n], seqs_1[:n], names_2[:n], seqs_2[:n]
+        yield names, seqs
+    
+    for more_names, more_seqs in blocks_2:
+        names_2.extend(more_names)
+    assert not names_1 and not names_2, \
+        'Paired files %s and %s contain different numbers of reads' % (filename1, filename2)
+
+
+def _batches(blocks, batch_size, limit, group):
+    """ Divide blocks of reads into batches of at least batch_size bases,
+        not splitting groups of group consecutive reads. 
+        limit is in groups. 
+        
+        batch_size may be a function, called as each batch is started with 
+        the number of bases read so far, giving the size of that batch. """
+    
+    if callable(batch_size):
+        next_batch_size = batch_size
+    else:
+        next_batch_size = lambda bases_read: batch_size
+
+    batch = [ ]
+    batch_bases = 0
+    group_count = 0
+    bases_read = 0
+    target = None
+    for names, seqs in blocks:
+        if limit is not None and group_count*group + len(names) > limit*group:
+            names = names[:(limit-group_count)*group]
+            seqs = seqs[:(limit-group_count)*group]
+        group_count += len(names) // group
+        
+        lengths = map(len, seqs)
+        if group == 2:
+            lengths = numpy.add(lengths[0::2], lengths[1::2])
+
+        # Where each batch ends: the group that takes it to batch_size bases
+        ends = numpy.cumsum(lengths) + batch_bases
+        n_groups = len(ends)
+        if n_groups:
+            bases_read += int(ends[-1]) - batch_bases
+        start = 0
+        while True:
+            if target is None:
+                target = next_batch_size(bases_read)
+            cut = numpy.searchsorted(ends, target) + 1
+            if cut > n_groups: break
+            batch.extend(zip(names[start*group:cut*group], seqs[start*group:cut*group]))
+            yield batch
+            batch = [ ]
+            target = None
+            ends -= ends[cut-1]
+            ends[:cut] = -1
+            start = cut
+
+        batch.extend(zip(names[start*group:], seqs[start*group:]))
+        if start < n_groups:
+            batch_bases = int(ends[-1])
+        elif start:
+            batch_bases = 0
+
+        if limit is not None and group_count >= limit: break
+
+    if batch:
+        yield batch
+
+
+def read_batches(filename, batch_size, limit=None, solid=False):
+    """ Yield lists of (read_name, read_seq), each of at least batch_size
+        bases (except the last). Only the first limit reads are read if
+        limit is given. batch_size may be a function, see _batches. """
+
+    return _batches(read_blocks(filename, solid), batch_size, limit, 1)
+
+
+def read_paired_batches(filename1, filename2, batch_size, limit=None, solid=False):
+    """ As read_batches, for two files of paired reads. Each read is 
+        followed by its pair, and pairs are not split between batches.
+        Only the first limit pairs are read if limit is given. """
+
+    return _batches(read_paired_blocks(filename1, filename2, solid), batch_size, limit, 2)
+
+
+# Prepared references:
+#   reference.fa      - FASTA, name only on each header line, 
+#                       sequence in lines of REFERENCE_LINE_LENGTH
+#   reference.fa.fai  - as samtools faidx: name, length, offset of 
+#                       the sequence, bases per line, bytes per line
+#
+# A cache directory holds prepared references in subdirectories named 
+# by a hash of the contents of the input files.
+
+REFERENCE_LINE_LENGTH = 60
+
+def reference_key(input_filenames):
+    """ Hash of the contents of a list of reference files. """
+    
+    key = hashlib.sha1('reference %d\n' % REFERENCE_LINE_LENGTH)
+    for filename in input_filenames:
+        file_hash = hashlib.sha1()
+        f = open(filename,'rb')
+        for chunk in _chunks_from_file(f):
+            file_hash.update(chunk)
+        f.close()
+        key.update(file_hash.hexdigest() + '\n')
+    return key.hexdigest()
+
+
+def write_reference(input_filenames, filename):
+    """ Write the sequences in input_filenames (FASTA, possibly gzipped) 
+        to filename as a prepared reference, with its .fai index. """
+    
+    out = open(filename,'wb')
+    index = open(filename+'.fai','wb')
+    offset = 0
+    for input_filename in input_filenames:
+        f = open_possibly_compressed_file(input_filename)
+        for names, seqs in _fasta_blocks(_chunks_from_file(f)):
+            for name, seq in itertools.izip(names, seqs):
+                header = '>%s\n' % name
+                lines = [ seq[i:i+REFERENCE_LINE_LENGTH] 
+                          for i in xrange(0, len(seq), REFERENCE_LINE_LENGTH) ]
+                text = ''.join([ line + '\n' for line in lines ])
+                out.write(header + text)
+                index.write('%s\t%d\t%d\t%d\t%d\n' % (
+                    name, len(seq), offset+len(header), REFERENCE_LINE_LENGTH, REFERENCE_LINE_LENGTH+1))
+                offset += len(header) + len(text)
+        f.close()
+    out.close()
+    index.close()
+
+
+def _link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        #Different filesystem
+        shutil.copyfile(source, destination)
+
+def prepare_reference(input_filenames, filename, cache_dir=None):
+    """ Prepare a reference in filename (and filename.fai) from the 
+        sequences in input_filenames.
+        
+        If cache_dir is given, the prepared reference is taken from there 
+        if these files have been prepared before (hard linked, or copied if 
+        cache_dir is on another filesystem), otherwise it is prepared there. 
+        Returns True if the reference came from the cache. """
+    
+    #Never write through an existing file, it may be a link into the cache
+    for name in (filename, filename+'.fai'):
+        if os.path.exists(name):
+            os.unlink(name)
+    
+    if cache_dir is None:
+        write_reference(input_filenames, filename)
+        return False
+    
+    cached_dir = os.path.join(cache_dir, reference_key(input_filenames))
+    cached_filename = os.path.join(cached_dir, 'reference.fa')
+    found = os.path.exists(cached_filename+'.fai')
+    if not found:
+        #Prepared under a temporary name, then renamed into place,
+        #so runs sharing the cache never see a partly written reference
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp_dir = '%s.%s-%d' % (cached_dir, socket.gethostname(), os.getpid())
+        if not os.path.isdir(temp_dir):
+            os.mkdir(temp_dir)
+        write_reference(input_filenames, os.path.join(temp_dir,'reference.fa'))
+        for name in ('reference.fa', 'reference.fa.fai'):
+            os.chmod(os.path.join(temp_dir,name), 0444)
+        try:
+            os.rename(temp_dir, cached_dir)
+        except OSError:
+            #Another run prepared it first
+            shutil.rmtree(temp_dir, True)
+    
+    _link_or_copy(cached_filename, filename)
+    _link_or_copy(cached_filename+'.fai', filename+'.fai')
+    return found
+
+
+def read_reference_index(filename):
+    """ [ (name, length, offset, bases per line, bytes per line) ] from 
+        the .fai index of a prepared reference, or None if there is no 
+        index or it is older than the reference. """
+    
+    index_filename = filename + '.fai'
+    if not os.path.exists(index_filename) or \
+       os.path.getmtime(index_filename) < os.path.getmtime(filename):
+        return None
+    
+    result = [ ]
+    for line in open(index_filename,'rb'):
+        fields = line.rstrip('\n').split('\t')
+        result.append((fields[0],) + tuple([ int(item) for item in fields[1:5] ]))
+    return result
+
+def read_reference(filename):
+    """ Yield (name, sequence) for each sequence in a reference.
+        A prepared reference is read via mmap using its index, 
+        otherwise the file is parsed as FASTA. """
+    
+    index = read_reference_index(filename)
+    if index is None:
+        f = open_possibly_compressed_file(filename)
+        for names, seqs in _fasta_blocks(_chunks_from_file(f)):
+            for item in itertools.izip(names, seqs):
+                yield item
+        f.close()
+        return
+    
+    f = open(filename,'rb')
+    size = os.fstat(f.fileno()).st_size
+    if not size: return
+    data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        for name, length, offset, line_bases, line_bytes in index:
+            n_lines = (length + line_bases - 1) // line_bases
+            text = data[offset:offset + length + n_lines*(line_bytes-line_bases)]
+            seq = text.replace('\n','')
+            assert len(seq) == length and data[offset-1] == '\n', \
+                'Index %s.fai does not match %s' % (filename, filename)
+            yield name, seq
+    finally:
+        data.close()
+        f.close()
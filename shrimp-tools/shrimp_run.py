@@ -12,12 +12,49 @@ Run shrimp, set up directory for shrimp_consensus
 0.5 - no longer compress,
       so shrimp_consensus can seek in hit file
 
+0.6 - start the next batch as soon as any SHRiMP finishes,
+      rather than waiting for the oldest
+
+0.7 - reading reads and merging output done in separate threads,
+      overlapping with running SHRiMP
+      reads not kept in memory while SHRiMP runs, unmapped reads
+      are copied from the temporary reads file
+
+0.8 - reads files read in large chunks by shrimp_reads.py,
+      gzipped reads files supported
+
+0.9 - added --paired option, to keep read pairs in the same batch
+      so their hits are adjacent in shrimp_hits.txt
+
+0.10 - completed batches recorded in batches.txt,
+       an interrupted run is resumed when re-run with the same options
+
+0.11 - added --queue and --worker options, to run SHRiMP on other machines
+       via a shared directory
+
+0.12 - batch sizes chosen from measured SHRiMP speed and the amount 
+       of input remaining, added --fixed-batch-size,
+       run summary written to run_summary.txt
+
+0.13 - aligner run via shrimp_aligners.py, added --aligner option
+       (including a fake aligner for testing)
+
+0.14 - temporary files in local scratch space or /dev/shm rather than 
+       the output directory, added --tmpdir and --pipe options
+
+0.15 - added --dedup option, to align each distinct read sequence 
+       in a batch only once
+
+0.16 - reference prepared by shrimp_reads.py, with a .fai index,
+       added --reference-cache option to reuse prepared references
+
 """
 
-VERSION = '0.5'
+VERSION = '0.16'
+
+import sys, os, ast, time, hashlib, socket, pprint, traceback, mmap, threading, Queue, tempfile, shutil, atexit, cStringIO
 
-import sys, os, pprint, gzip
-from Bio import SeqIO
+import shrimp_reads, shrimp_aligners
 
 def how_many_cpus():
     """Detects the number of effective CPUs in the system,
@@ -80,72 +117,165 @@ def get_flag(argv, flag):
     return any, argv
 
 
-def open_possibly_compressed_file(filename):
-    if filename.endswith('.gz'):
-        return gzip.open(filename,'rb')
-    else:
-        return open(filename,'rb')
+def batch_records(data):
+    """ (read name, record) for each read in a batch of reads as written 
+        by prepare_shrimp ('>name\nseq\n' each, in a string or mmap). """
+    
+    size = len(data)
+    start = 0
+    while start < size:
+        name_end = data.find('\n', start)
+        end = data.find('\n', name_end+1) + 1
+        yield data[start+1:name_end], data[start:end]
+        start = end
+
+def batch_records_in_file(filename):
+    """ batch_records for a temporary reads file. """
+    
+    f = open(filename,'rb')
+    size = os.fstat(f.fileno()).st_size
+    if not size: return
+    data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        for item in batch_records(data):
+            yield item
+    finally:
+        data.close()
+        f.close()
+
+def unmapped_records(records, reads_seen):
+    """ Records from batch_records whose read names are not in reads_seen. """
+    
+    for read_name, record in records:
+        if read_name not in reads_seen:
+            yield record
 
 
-def read_solid(filename):
-    reads_file = open(filename,'rU')
+def unique_reads(read_set):
+    """ Collapse reads with identical sequences.
+        Returns a list of the distinct sequences, 
+        and for each read the index of its sequence in that list. """
     
-    while True:
-        line1 = reads_file.readline()
-        while line1.startswith('#'):
-            line1 = reads_file.readline()
-        if not line1: break
-        assert line1.startswith('>'), 'Not a SOLiD CSFASTA file?'
-        line2 = reads_file.readline()
+    index = { }
+    unique_seqs = [ ]
+    unique_ids = [ ]
+    for read_name, read_seq in read_set:
+        unique_id = index.get(read_seq)
+        if unique_id is None:
+            unique_id = index[read_seq] = len(unique_seqs)
+            unique_seqs.append(read_seq)
+        unique_ids.append(unique_id)
+    return unique_seqs, unique_ids
 
-        read_name = line1.rstrip('\n')[1:]
-        read_seq = line2.rstrip('\n')
-        yield read_name, read_seq
 
-def read_illumina(filename):
-    reads_file = open(filename,'rU')
+def choose_tmpdir(space_needed):
+    """ /dev/shm if it has space_needed bytes free, 
+        otherwise the system's temporary directory. """
+    
+    for directory in [ '/dev/shm', tempfile.gettempdir() ]:
+        if not os.path.isdir(directory) or not os.access(directory, os.W_OK): continue
+        stat = os.statvfs(directory)
+        if stat.f_bavail * stat.f_frsize >= space_needed:
+            return directory
+    return tempfile.gettempdir()
+
+
+# Shared queue directory (see --queue, --worker):
+#   job.txt       - aligner and options, written by the coordinator
+#   reference.fa  - reference, copied there by the coordinator
+#   new/          - batches being written by the coordinator
+#   todo/         - batches waiting for a worker
+#   claimed/      - batches a worker is running SHRiMP on, 
+#                   claimed by renaming from todo/, which only one worker can do.
+#                   The worker touches the file every QUEUE_HEARTBEAT_INTERVAL, 
+#                   if it goes QUEUE_STALE_CLAIM seconds without being touched
+#                   the worker is presumed dead and the coordinator puts the
+#                   batch back in todo/
+#   done/         - batches with SHRiMP's output and a .status file containing 
+#                   its exit status and run time, which is written last
+#   finished      - created by the coordinator when all batches are done, workers then exit
+
+QUEUE_POLL_INTERVAL = 1.0
+QUEUE_HEARTBEAT_INTERVAL = 10.0
+QUEUE_STALE_CLAIM = 120.0
+
+def claim_batch(queue_dir, me):
+    """ Claim a batch waiting in queue_dir/todo. 
+        Returns the batch name and the claimed reads file, or None. """
+
+    todo_dir = os.path.join(queue_dir,'todo')
+    for filename in sorted(os.listdir(todo_dir)):
+        if not filename.endswith('.fa'): continue
+        name = filename[:-3]
+        claimed_filename = os.path.join(queue_dir,'claimed','%s.%s.fa' % (name,me))
+        try:
+            os.rename(os.path.join(todo_dir,filename), claimed_filename)
+        except OSError:
+            #Another worker got there first
+            continue
+        os.utime(claimed_filename, None)
+        return name, claimed_filename
+    return None
+
+def run_worker(queue_dir, verbose):
+    """ Run SHRiMP on batches from a shared queue directory 
+        until the coordinator has finished. """
+    
+    me = '%s-%d' % (socket.gethostname(), os.getpid())
+    job_filename = os.path.join(queue_dir,'job.txt')
     
+    print 'Worker %s waiting for batches in %s' % (me, queue_dir)
     while True:
-        line1 = reads_file.readline()
-        if not line1: break
-        line2 = reads_file.readline()
-        line3 = reads_file.readline()
-        line4 = reads_file.readline()
-            
-        assert line1.startswith('@'), 'Not an Illumina FASTQ file?'
-        assert line3.startswith('+'), 'Not an Illumina FASTQ file?'
-            
-        read_name = line1.rstrip('\n')[1:]
-        read_seq = line2.rstrip('\n')
-        yield read_name, read_seq
-
-def read_fasta(filename):
-    reads_file = open(filename,'rU')
-    
-    line = reads_file.readline()
-    while line:
-        line = line.rstrip()
-        assert line.startswith('>'), 'Not a FASTA file?'
-        read_name = line[1:].split()[0]
+        claim = None
+        if os.path.exists(job_filename):
+            claim = claim_batch(queue_dir, me)
         
-        line = reads_file.readline()
-        parts = [ ]
-        while line and not line.startswith('>'):
-            parts.append(line.rstrip())
-            line = reads_file.readline()
+        if claim is None:
+            if os.path.exists(os.path.join(queue_dir,'finished')): break
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
         
-        yield read_name, ''.join(parts)
+        name, claimed_filename = claim
+        claimed_filename_out = claimed_filename[:-3] + '.txt'
         
-def read_fasta_or_illumina(filename):
-    reads_file = open(filename,'rU')    
-    line = reads_file.readline()
-    if line.startswith('>'):
-        return read_fasta(filename)
-    else:
-        return read_illumina(filename)
+        print 'SHRiMP %s running' % name
+        start = time.time()
+        try:
+            job = ast.literal_eval(open(job_filename,'rb').read())
+            aligner = shrimp_aligners.get_aligner(job['aligner'], job['shrimp_options'], job['solid'])
+            process = aligner.run(claimed_filename, os.path.join(queue_dir,'reference.fa'), claimed_filename_out, verbose)
+            
+            last_heartbeat = time.time()
+            while process.poll() is None:
+                time.sleep(QUEUE_POLL_INTERVAL)
+                if time.time() - last_heartbeat >= QUEUE_HEARTBEAT_INTERVAL:
+                    os.utime(claimed_filename, None)
+                    last_heartbeat = time.time()
+            exit_status = process.returncode
+        except Exception:
+            #Report failure to the coordinator, rather than leave it waiting
+            traceback.print_exc()
+            exit_status = -1
+            if not os.path.exists(claimed_filename_out):
+                open(claimed_filename_out,'wb').close()
+        seconds = time.time() - start
         
-   
+        done_dir = os.path.join(queue_dir,'done')
+        try:
+            os.rename(claimed_filename, os.path.join(done_dir, name+'.fa'))
+        except OSError:
+            print >> sys.stderr, 'SHRiMP %s was given to another worker, discarding output' % name
+            os.unlink(claimed_filename_out)
+            continue
+        os.rename(claimed_filename_out, os.path.join(done_dir, name+'.txt'))
+        f = open(os.path.join(done_dir, name+'.status.'+me),'wb')
+        f.write('%d\t%.3f\n' % (exit_status, seconds))
+        f.close()
+        os.rename(os.path.join(done_dir, name+'.status.'+me), os.path.join(done_dir, name+'.status'))
+        print 'SHRiMP %s finished' % name
     
+    print 'Worker %s finished' % me
+        
 
 argv = sys.argv[1:]
 
@@ -156,10 +286,24 @@ n_cpus = how_many_cpus()
 #fasta, argv = get_flag(argv, '--fasta')
 solid, argv = get_flag(argv, '--solid')
 verbose, argv = get_flag(argv, '--verbose')
+paired, argv = get_flag(argv, '--paired')
+
+aligner_name, argv = get_option_value(argv, '--aligner', str, 'shrimp')
+queue_dir, argv = get_option_value(argv, '--queue', os.path.abspath, None)
+worker_dir, argv = get_option_value(argv, '--worker', os.path.abspath, None)
+if worker_dir is not None:
+    run_worker(worker_dir, verbose)
+    sys.exit(0)
 
 limit, argv = get_option_value(argv, '--limit', int, None)
 max_shrimps, argv = get_option_value(argv, '--cpus', int, n_cpus)
 batch_size, argv = get_option_value(argv, '--batch-size', int, 30000000)
+fixed_batch_size, argv = get_flag(argv, '--fixed-batch-size')
+tmpdir, argv = get_option_value(argv, '--tmpdir', str, None)
+pipe, argv = get_flag(argv, '--pipe')
+dedup, argv = get_flag(argv, '--dedup')
+reference_cache, argv = get_option_value(argv, '--reference-cache', os.path.abspath, 
+                                         os.environ.get('SHRIMP_REFERENCE_CACHE'))
 
 #Default to Illumina reads
 #if not illumina and not fasta and not solid:
@@ -177,24 +321,64 @@ Usage:
         --reads s_X_1_sequence.txt [...] \\
         [--shrimp-options ...options to pass directly to rmapper-xx... ]
 
+    shrimp_run.py --worker queue_directory [--verbose]
+
 Options:
 
   --solid         - Reads are from a SOLiD sequencer, ie colorspace
                     (Default is FASTA or FASTQ format)
+  --paired        - Read files are pairs of files of paired reads,
+                    the 1st with the 2nd, the 3rd with the 4th, etc.
+                    Hits to each read pair will be adjacent in the output
+                    (see shrimp_consensus.py --stream)
   
   --verbose       - Show output from SHRiMP
   --cpus N        - How many SHRiMPs to run in parallel 
                     (default: the number of CPUs in your system, %d)
-  --batch-size N  - How many bases worth of reads to use in each SHRiMP invocation 
+  --batch-size N  - Maximum bases worth of reads to use in each SHRiMP invocation 
                     (default: 30000000)
+                    Batches are sized from the measured speed of SHRiMP 
+                    and the input remaining, becoming smaller toward the end
+                    so that all SHRiMPs finish at about the same time.
+  --fixed-batch-size
+                  - Use --batch-size bases in every batch
+  
+  --tmpdir DIR    - Where to put temporary files (default: /dev/shm if 
+                    it has room, otherwise $TMPDIR or /tmp)
+  --pipe          - Feed reads to SHRiMP through a named pipe and read its 
+                    output directly, rather than using temporary files
+                    (the aligner must read its input only once)
+  --dedup         - Align each distinct read sequence in a batch only once,
+                    copying its hits to every read with that sequence
+  
+  --reference-cache DIR
+                  - Keep prepared references in DIR, and reuse them when 
+                    the same reference files are given again
+                    (default: $SHRIMP_REFERENCE_CACHE, if set)
+  
+  --aligner NAME  - Aligner to use (see shrimp_aligners.py):
+                      shrimp - SHRiMP (default)
+                      fake   - a fake SHRiMP, for testing
+  
+  --queue DIR     - Don't run SHRiMP here, instead put batches in shared 
+                    directory DIR to be run by any number of 
+                    "shrimp_run.py --worker DIR" processes, on any machine 
+                    that can see DIR. --cpus is then the number of batches
+                    to have waiting or running at once.
+                    Only one run at a time should use DIR.
   
   --limit N       - Only read N reads from each file
+                    (or N read pairs with --paired)
 
 Quality information will not be used.
 
 You can supply as many reference and read files as you like.
 
 Files may be gzipped.
+
+Completed batches are recorded in output_directory/batches.txt. If a run 
+is interrupted, running it again with the same reference, reads and
+SHRiMP options resumes it, only aligning reads not yet done.
 """ % n_cpus
     sys.exit(0)
 
@@ -222,119 +406,576 @@ for item in argv[1:]:
 
 assert input_reference_filenames, 'No reference files given'
 assert reads_filenames, 'No read files given'
+assert not paired or len(reads_filenames) % 2 == 0, '--paired requires an even number of read files'
+assert not (pipe and queue_dir), '--pipe can not be used with --queue'
 
+#Batch files and SHRiMP output, each maybe somewhat larger than batch_size
+if tmpdir is None:
+    tmpdir = choose_tmpdir(batch_size * max_shrimps * 4)
+
+#Named after the output directory, so if a run is killed its temporary 
+#files are removed when it is resumed (or the directory is reused)
+temp_name = 'shrimp_run-' + hashlib.sha1(os.path.realpath(output_dir)).hexdigest()[:16]
+for directory in set([ tmpdir, '/dev/shm', tempfile.gettempdir() ]):
+    shutil.rmtree(os.path.join(directory, temp_name), True)
+temp_dir = os.path.join(tmpdir, temp_name)
+os.mkdir(temp_dir)
+atexit.register(shutil.rmtree, temp_dir, True)
 
 
-#shrimp = '~/tmp/SHRiMP_1_1_0/bin/rmapper-ls'
-#shrimp = 'rmapper-ls'
-if solid:
-    shrimp = 'rmapper-cs'
-else:
-    shrimp = 'rmapper-ls'
+
+aligner = shrimp_aligners.get_aligner(aligner_name, shrimp_options, solid)
 
 
 reference_filename = os.path.join(output_dir,'reference.fa')
-reference_file = open(reference_filename,'wb')
-for input_reference_filename in input_reference_filenames:
-    f = open_possibly_compressed_file(input_reference_filename)
-    reader = SeqIO.parse(f,'fasta')
-    for record in reader:
-        record.description = ''
-        SeqIO.write([record], reference_file, 'fasta')
-reference_file.close()
+if shrimp_reads.prepare_reference(input_reference_filenames, reference_filename, reference_cache):
+    print 'Reference taken from cache', reference_cache
 
 config = {
     'reads' : reads_filenames,
-    'solid': solid
+    'solid': solid,
+    'paired': paired,
+    'references': input_reference_filenames,
+    'aligner': aligner_name,
+    'shrimp_options': shrimp_options
 }
-config_file = open(os.path.join(output_dir, 'config.txt'), 'wb')
-pprint.pprint(config, config_file)
-config_file.close()
+config_filename = os.path.join(output_dir, 'config.txt')
+manifest_filename = os.path.join(output_dir, 'batches.txt')
+output_filename = os.path.join(output_dir, 'shrimp_hits.txt')
+unmapped_filename = os.path.join(output_dir, 'unmapped.fa')
+
+
+# Batch manifest, batches.txt: 
+#   a line for each batch as it is started and as it is finished, giving
+#   the reads file (or pair of files), the range of reads (or read pairs) in the batch, 
+#   its status (started/done/failed) and, once done, the byte ranges of its 
+#   output in shrimp_hits.txt and unmapped.fa
 
-#output_file = gzip.open(os.path.join(output_dir, 'shrimp_hits.txt.gz'), 'wb')
-output_file = open(os.path.join(output_dir, 'shrimp_hits.txt'), 'wb')
-unmapped_file = open(os.path.join(output_dir, 'unmapped.fa'), 'wb')
+MANIFEST_HEADER = '#batch\treads\tfirst\tcount\tstatus\thits_start\thits_end\tunmapped_start\tunmapped_end\n'
 
+def read_manifest(filename):
+    """ Returns { reads: [ (first, count) ] } of batches done,
+        the next unused batch number, and the sizes shrimp_hits.txt and 
+        unmapped.fa had when the last batch was done. """
+    
+    done = { }
+    next_batch = 0
+    sizes = (0, 0)
+    for line in open(filename,'rb'):
+        if line.startswith('#'): continue
+        parts = line.rstrip('\n').split('\t')
+        if len(parts) != 9: break #Partially written line
+        next_batch = max(next_batch, int(parts[0])+1)
+        if parts[4] == 'done':
+            done.setdefault(parts[1], [ ]).append( (int(parts[2]), int(parts[3])) )
+            sizes = (int(parts[6]), int(parts[8]))
+    
+    for ranges in done.values():
+        ranges.sort()
+    return done, next_batch, sizes
+
+def unfinished_parts(ranges, first, count):
+    """ Parts of the range first..first+count-1 not covered by ranges,
+        as [ (first, count) ]. """
+    
+    result = [ ]
+    for done_first, done_count in ranges:
+        if done_first+done_count <= first or done_first >= first+count: continue
+        if done_first > first:
+            result.append( (first, done_first-first) )
+        count = first+count - max(first, done_first+done_count)
+        first = max(first, done_first+done_count)
+        if count <= 0: return result
+    result.append( (first, count) )
+    return result
+
+
+done = { }
 N = 0
-def do_shrimp(read_set):
-    global N
-    my_number = N
-    N += 1
-    tempname = os.path.join(output_dir,'temp%d-%d.fa' % (os.getpid(),my_number))
-    tempname_out = os.path.join(output_dir,'temp%d-%d.txt' % (os.getpid(),my_number))
-    f = open(tempname,'wb')
-    for read_name, read_seq in read_set:
-        print >> f, '>' + read_name
-        print >> f, read_seq
+resume = False
+if os.path.exists(manifest_filename) and os.path.exists(config_filename) and \
+   open(config_filename,'rb').read() == pprint.pformat(config)+'\n':
+    done, N, (output_size, unmapped_size) = read_manifest(manifest_filename)
+    resume = os.path.exists(output_filename) and os.path.getsize(output_filename) >= output_size and \
+             os.path.exists(unmapped_filename) and os.path.getsize(unmapped_filename) >= unmapped_size
+
+if resume:
+    print 'Resuming: %d %s already done' % (
+        sum([ count for ranges in done.values() for first, count in ranges ]),
+        paired and 'read pairs' or 'reads')
+    
+    output_file = open(output_filename, 'r+b')
+    output_file.truncate(output_size)
+    output_file.seek(0, 2)
+    unmapped_file = open(unmapped_filename, 'r+b')
+    unmapped_file.truncate(unmapped_size)
+    unmapped_file.seek(0, 2)
+    manifest_file = open(manifest_filename, 'ab')
+else:
+    done = { }
+    N = 0
+
+    config_file = open(config_filename, 'wb')
+    pprint.pprint(config, config_file)
+    config_file.close()
+
+    #output_file = gzip.open(os.path.join(output_dir, 'shrimp_hits.txt.gz'), 'wb')
+    output_file = open(output_filename, 'wb')
+    unmapped_file = open(unmapped_filename, 'wb')
+    manifest_file = open(manifest_filename, 'wb')
+    manifest_file.write(MANIFEST_HEADER)
+    manifest_file.flush()
+
+if queue_dir is not None:
+    for subdir in ('new','todo','claimed','done'):
+        if not os.path.isdir(os.path.join(queue_dir,subdir)):
+            os.makedirs(os.path.join(queue_dir,subdir))
+    #Anything left from an earlier run, including batches claimed by workers that died
+    for subdir in ('new','todo','claimed','done'):
+        for filename in os.listdir(os.path.join(queue_dir,subdir)):
+            os.unlink(os.path.join(queue_dir,subdir,filename))
+    if os.path.exists(os.path.join(queue_dir,'finished')):
+        os.unlink(os.path.join(queue_dir,'finished'))
+    
+    shutil.copyfile(reference_filename, os.path.join(queue_dir,'reference.fa'))
+    f = open(os.path.join(queue_dir,'job.txt.new'),'wb')
+    pprint.pprint({ 'aligner' : aligner_name, 'shrimp_options' : shrimp_options, 'solid' : solid }, f)
     f.close()
+    os.rename(os.path.join(queue_dir,'job.txt.new'), os.path.join(queue_dir,'job.txt'))
+
+manifest_lock = threading.Lock()
+def write_manifest(*fields):
+    manifest_lock.acquire()
+    try:
+        manifest_file.write('\t'.join([ str(item) for item in fields ]) + '\n')
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    finally:
+        manifest_lock.release()
+
+
+MIN_BATCH_SECONDS = 30.0
 
-    command = shrimp + ' ' + ' '.join(shrimp_options) + ' ' + \
-              tempname + ' ' + reference_filename + ' >' + tempname_out
-    if not verbose:
-        command += ' 2>/dev/null'
-    #f = os.popen(command, 'r')
-    child_pid = os.spawnl(os.P_NOWAIT,'/bin/sh','/bin/sh','-c',command)
-    print 'SHRiMP %d running' % my_number
+class Batch_sizer(object):
+    """ Choose the size of each batch from the measured speed of SHRiMP
+        and an estimate of the bases still to be read. """
+
+    def __init__(self, max_size, n_shrimps, input_bytes):
+        self.max_size = max_size
+        self.n_shrimps = n_shrimps
+        self.input_bytes = input_bytes
+        
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.n_batches = 0
+        self.n_reads = 0
+        self.n_bases = 0
+        self.shrimp_seconds = 0.0
+        self.n_duplicates = 0
+        self.duplicate_bases = 0
+        self.smallest = None
+        self.largest = None
+    
+    def record(self, n_reads, n_bases, seconds, n_duplicates=0, duplicate_bases=0):
+        """ Record a completed batch. n_duplicates and duplicate_bases
+            are the reads and bases not aligned because of --dedup. """
+        
+        self.lock.acquire()
+        try:
+            self.n_batches += 1
+            self.n_reads += n_reads
+            self.n_bases += n_bases
+            self.shrimp_seconds += seconds
+            self.n_duplicates += n_duplicates
+            self.duplicate_bases += duplicate_bases
+            self.smallest = min(self.smallest or n_bases, n_bases)
+            self.largest = max(self.largest, n_bases)
+        finally:
+            self.lock.release()
     
-    def finalize():
-        os.waitpid(child_pid, 0)
+    def bases_per_second(self):
+        """ Bases aligned per second by each SHRiMP, or None if not yet known. """
         
-        reads_seen = { }
+        self.lock.acquire()
+        try:
+            if not self.shrimp_seconds: return None
+            return self.n_bases / self.shrimp_seconds
+        finally:
+            self.lock.release()
+    
+    def size(self, bases_read, bases_queued):
+        """ Size of the next batch, given the bases read from the input 
+            so far and the bases put into batches so far.
+            
+            Each batch is half the remaining bases' fair share among 
+            the SHRiMPs, so batches shrink toward the end of the input, 
+            but (once SHRiMP's speed is known) not so small that a batch
+            takes under MIN_BATCH_SECONDS. """
         
-        for line in open(tempname_out,'rb'):
-            if line.startswith('>'):
-                read_name = line.split(None,1)[0][1:]
-                reads_seen[read_name] = True
-            output_file.write(line)
+        input_read = shrimp_reads.bytes_read()
+        remaining = bases_read - bases_queued
+        if input_read:
+            remaining += bases_read * max(0, self.input_bytes-input_read) / float(input_read)
+        
+        rate = self.bases_per_second()
+        if rate is None:
+            smallest = 1
+        else:
+            smallest = rate * MIN_BATCH_SECONDS
+        
+        size = max(smallest, remaining / (2*self.n_shrimps))
+        return max(1, int(min(self.max_size, size)))
+    
+    def summary_text(self):
+        rate = self.bases_per_second() or 0.0
+        elapsed = time.time() - self.start_time
+        text = (
+            '%20d batches aligned (%d to %d bases)\n' % (self.n_batches, self.smallest or 0, self.largest or 0) +
+            '%20d reads\n' % self.n_reads +
+            '%20d bases\n' % self.n_bases +
+            '%20.1f seconds elapsed\n' % elapsed +
+            '%20.1f seconds of SHRiMP time\n' % self.shrimp_seconds +
+            '%20.0f bases/second per SHRiMP\n' % rate +
+            '%20.0f bases/second overall\n' % (self.n_bases / max(elapsed,1e-9))
+        )
+        if dedup:
+            #Time saved estimated from the speed SHRiMP aligned the distinct reads
+            aligned_bases = self.n_bases - self.duplicate_bases
+            if aligned_bases:
+                seconds_saved = self.duplicate_bases * self.shrimp_seconds / aligned_bases
+            else:
+                seconds_saved = 0.0
+            text += (
+                '%20d duplicate reads not aligned (%.1f%%)\n' % (self.n_duplicates, 100.0 * self.n_duplicates / max(self.n_reads,1)) +
+                '%20.1f seconds of SHRiMP time saved (estimated)\n' % seconds_saved
+            )
+        return text
+
+batch_sizer = Batch_sizer(batch_size, max_shrimps, 
+                          sum([ os.path.getsize(filename) for filename in reads_filenames ]))
+
+
+def prepare_shrimp(reads, first, count, read_set):
+    """ Write a batch of reads to a temporary file.
+        Returns a function to launch SHRiMP on it. """
+
+    global N
+    my_number = N
+    N += 1
+    if queue_dir is None:
+        tempname = os.path.join(temp_dir,'temp%d-%d.fa' % (os.getpid(),my_number))
+        tempname_out = os.path.join(temp_dir,'temp%d-%d.txt' % (os.getpid(),my_number))
+    else:
+        queue_name = '%s-%d-%d' % (socket.gethostname(), os.getpid(), my_number)
+        tempname = os.path.join(queue_dir,'done',queue_name+'.fa')
+        tempname_out = os.path.join(queue_dir,'done',queue_name+'.txt')
+        new_name = os.path.join(queue_dir,'new',queue_name+'.fa')
+    
+    batch_text = ''.join([ '>%s\n%s\n' % item for item in read_set ])
+    n_reads = len(read_set)
+    n_bases = sum([ len(item[1]) for item in read_set ])
+    
+    if dedup:
+        #SHRiMP sees each distinct sequence once, named by its number,
+        #the batch itself is kept to name the hits and find unmapped reads
+        unique_seqs, unique_ids = unique_reads(read_set)
+        n_duplicates = n_reads - len(unique_seqs)
+        duplicate_bases = n_bases - sum(map(len, unique_seqs))
+        aligner_text = ''.join([ '>%d\n%s\n' % item for item in enumerate(unique_seqs) ])
+        del unique_seqs
+        reads_tempname = os.path.join(temp_dir,'reads%d-%d.fa' % (os.getpid(),my_number))
+    else:
+        n_duplicates = 0
+        duplicate_bases = 0
+        aligner_text = batch_text
+        reads_tempname = tempname
+    
+    if pipe:
+        #Kept in memory until finalize
+        output = [ ]
+    else:
+        f = open(queue_dir is None and tempname or new_name,'wb')
+        f.write(aligner_text)
         f.close()
-        output_file.flush()
+        if dedup:
+            f = open(reads_tempname,'wb')
+            f.write(batch_text)
+            f.close()
+        batch_text = None
+        aligner_text = None
+
+    def launch():
+        """ Start SHRiMP. Returns a function to wait for it to finish,
+            giving its exit status, and finalize. """
+        
+        if queue_dir is not None:
+            os.rename(new_name, os.path.join(queue_dir,'todo',queue_name+'.fa'))
+            write_manifest(my_number, reads, first, count, 'started', '-', '-', '-', '-')
+            print 'SHRiMP %d queued' % my_number
+            return wait_for_queue, finalize
+        
+        #f = os.popen(command, 'r')
+        start = time.time()
+        if pipe:
+            os.mkfifo(tempname)
+            process = aligner.run(tempname, reference_filename, None, verbose)
+            feeder = start_thread(feed_pipe, tempname, aligner_text)
+        else:
+            process = aligner.run(tempname, reference_filename, tempname_out, verbose)
+        write_manifest(my_number, reads, first, count, 'started', '-', '-', '-', '-')
+        print 'SHRiMP %d running' % my_number
+        
+        def wait_for_child():
+            if pipe:
+                output.append(process.stdout.read())
+            exit_status = process.wait()
+            if pipe:
+                #Release the feeder if SHRiMP didn't read all its input
+                release_pipe(tempname)
+                feeder.join()
+            return exit_status, time.time() - start
+        return wait_for_child, finalize
+    
+    def wait_for_queue():
+        status_filename = os.path.join(queue_dir,'done',queue_name+'.status')
+        claimed_dir = os.path.join(queue_dir,'claimed')
+        while not os.path.exists(status_filename):
+            time.sleep(QUEUE_POLL_INTERVAL)
+            
+            #Requeue the batch if its worker has stopped touching it
+            for filename in os.listdir(claimed_dir):
+                if not (filename.startswith(queue_name+'.') and filename.endswith('.fa')): continue
+                claimed_filename = os.path.join(claimed_dir, filename)
+                try:
+                    if time.time() - os.path.getmtime(claimed_filename) < QUEUE_STALE_CLAIM: continue
+                    os.rename(claimed_filename, os.path.join(queue_dir,'todo',queue_name+'.fa'))
+                except OSError:
+                    #The worker finished after all
+                    continue
+                print >> sys.stderr, 'SHRiMP %d: worker %s seems to have died, batch requeued' % (
+                    my_number, filename[len(queue_name)+1:-3])
+        exit_status, seconds = open(status_filename,'rb').read().split()
+        os.unlink(status_filename)
+        return int(exit_status), float(seconds)
+    
+    def finalize(exit_status, seconds):
+        if exit_status != 0:
+            print >> sys.stderr, 'SHRiMP %d exited with status %d, its reads will be retried if the run is resumed' % (my_number, exit_status)
+            write_manifest(my_number, reads, first, count, 'failed', '-', '-', '-', '-')
+            os.unlink(tempname)
+            if not pipe:
+                os.unlink(tempname_out)
+                if dedup:
+                    os.unlink(reads_tempname)
+            return
+        
+        output_start = output_file.tell()
+        unmapped_start = unmapped_file.tell()
+        reads_seen = set()
+        
+        if pipe:
+            hit_file = cStringIO.StringIO(output.pop())
+            records = batch_records(batch_text)
+        else:
+            hit_file = open(tempname_out,'rb')
+            records = batch_records_in_file(reads_tempname)
         
-        for read_name, read_seq in read_set:
-            if read_name not in reads_seen:
-                print >> unmapped_file, '>' + read_name
-                print >> unmapped_file, read_seq
+        if dedup:
+            #Hits to each distinct sequence, copied to each read in the 
+            #batch with that sequence, in the order of the batch
+            unique_hits = { }
+            for line in aligner.hit_lines(hit_file):
+                unique_name = aligner.mapped_read_name(line)
+                if unique_name is None:
+                    output_file.write(line)
+                else:
+                    unique_hits.setdefault(int(unique_name), [ ]).append(line[len(unique_name)+1:])
+            
+            for i, (read_name, record) in enumerate(records):
+                hits = unique_hits.get(unique_ids[i])
+                if hits is None:
+                    unmapped_file.write(record)
+                else:
+                    for hit in hits:
+                        output_file.write('>' + read_name + hit)
+        else:
+            for line in aligner.hit_lines(hit_file):
+                read_name = aligner.mapped_read_name(line)
+                if read_name is not None:
+                    reads_seen.add(read_name)
+                output_file.write(line)
+            
+            for record in unmapped_records(records, reads_seen):
+                unmapped_file.write(record)
+        output_file.flush()
         unmapped_file.flush()
+        os.fsync(output_file.fileno())
+        os.fsync(unmapped_file.fileno())
+        
+        write_manifest(my_number, reads, first, count, 'done', 
+                       output_start, output_file.tell(), unmapped_start, unmapped_file.tell())
+        batch_sizer.record(n_reads, n_bases, seconds, n_duplicates, duplicate_bases)
 
         os.unlink(tempname)
-        os.unlink(tempname_out)
+        if not pipe:
+            os.unlink(tempname_out)
+            if dedup:
+                os.unlink(reads_tempname)
         print 'SHRiMP %d finished' % my_number
-    return finalize
+    
+    return launch
+
 
+# Pipeline:
+#   reader thread -> batch_queue -> main thread launches SHRiMPs, up to max_shrimps at once 
+#   -> a thread waiting on each SHRiMP -> finished_queue -> collector thread merges output
 
-shrimps = [ ]
-for reads_filename in reads_filenames:
-    #if illumina:
-    #    reader = read_illumina(reads_filename)
-    #elif fasta:
-    #    reader = read_fasta(reads_filename)
-    #else:
-    #    reader = read_solid(reads_filename)
+batch_queue = Queue.Queue(max_shrimps)
+finished_queue = Queue.Queue()
+slots = threading.Semaphore(max_shrimps)
+thread_errors = [ ]
+
+def start_thread(function, *args):
+    def run():
+        try:
+            function(*args)
+        except:
+            thread_errors.append(sys.exc_info())
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def feed_pipe(filename, text):
+    try:
+        f = open(filename,'wb')
+        f.write(text)
+        f.close()
+    except IOError:
+        #SHRiMP exited without reading everything, see release_pipe
+        pass
+
+def release_pipe(filename):
+    """ Unblock a feed_pipe waiting for a reader that has exited. """
     
-    if solid:
-        reader = read_solid(reads_filename)
-    else:
-        reader = read_fasta_or_illumina(reads_filename)
+    try:
+        os.close(os.open(filename, os.O_RDONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+# Bases read from the input files before the current one, and put into batches, 
+# for Batch_sizer
+bases_read_before = 0
+bases_queued = 0
+
+def next_batch_size(bases_read):
+    if fixed_batch_size:
+        return batch_size
+    return batch_sizer.size(bases_read_before + bases_read, bases_queued)
+
+def queue_batches(reads, batches, group):
+    """ Queue batches of reads (in groups of group reads, ie read pairs if 2) 
+        for SHRiMP, leaving out any reads done in a previous run. """
+    
+    global bases_read_before, bases_queued
+    
+    first = 0
+    for read_set in batches:
+        count = len(read_set) // group
+        bases_queued += sum([ len(item[1]) for item in read_set ])
+        for part_first, part_count in unfinished_parts(done.get(reads, [ ]), first, count):
+            start = (part_first-first)*group
+            part = read_set[start:start+part_count*group]
+            batch_queue.put(prepare_shrimp(reads, part_first, part_count, part))
+        first += count
+    bases_read_before = bases_queued
+
+def read_batches():
+    """ Reader thread: divide reads into batches and queue them for SHRiMP. """
+
+    try:
+        if paired:
+            for i in xrange(0, len(reads_filenames), 2):
+                queue_batches(reads_filenames[i] + ',' + reads_filenames[i+1],
+                              shrimp_reads.read_paired_batches(
+                                  reads_filenames[i], reads_filenames[i+1], next_batch_size, limit, solid),
+                              2)
+            return
+    
+        for reads_filename in reads_filenames:
+            #if illumina:
+            #    reader = read_illumina(reads_filename)
+            #elif fasta:
+            #    reader = read_fasta(reads_filename)
+            #else:
+            #    reader = read_solid(reads_filename)
+            
+            queue_batches(reads_filename,
+                          shrimp_reads.read_batches(reads_filename, next_batch_size, limit, solid),
+                          1)
+    finally:
+        batch_queue.put(None)
+
+def wait_for_shrimp(wait, finalize):
+    """ Wait for a SHRiMP to finish, free its slot, and pass it to the collector. """
     
-    read_count = 0
+    try:
+        exit_status, seconds = wait()
+    finally:
+        slots.release()
+    finished_queue.put((finalize, exit_status, seconds))
 
+def collect():
+    """ Collector thread: merge the output of each SHRiMP as it finishes. """
+    
     while True:
-        read_set = [ ]
-        read_set_bases = 0
-        for read_name, read_seq in reader:
-            if limit != None and read_count >= limit: break
-              
-            read_set.append((read_name, read_seq))
-            read_count += 1
-            read_set_bases += len(read_seq)
-            if read_set_bases >= batch_size: break
-        if not read_set: break
-    
-        if len(shrimps) >= max_shrimps:
-            shrimps.pop(0)()
-        shrimps.append( do_shrimp(read_set) )
-
-while shrimps:
-    shrimps.pop(0)()
+        item = finished_queue.get()
+        if item is None: break
+        finalize, exit_status, seconds = item
+        finalize(exit_status, seconds)
+
+
+reader_thread = start_thread(read_batches)
+collector_thread = start_thread(collect)
+
+waiter_threads = [ ]
+aborted = False
+while True:
+    launch = batch_queue.get()
+    if launch is None: break
+    
+    #Don't start any more SHRiMPs once a thread has failed
+    if not thread_errors:
+        slots.acquire()
+    if thread_errors:
+        aborted = True
+        print >> sys.stderr, 'Error, waiting for running SHRiMPs then stopping'
+        break
+    
+    wait, finalize = launch()
+    waiter_threads.append( start_thread(wait_for_shrimp, wait, finalize) )
+
+for thread in waiter_threads:
+    thread.join()
+finished_queue.put(None)
+collector_thread.join()
+if not aborted:
+    #(otherwise it may be blocked queueing a batch that will never be launched)
+    reader_thread.join()
 
 output_file.close()
 unmapped_file.close()
+manifest_file.close()
+
+if queue_dir is not None:
+    open(os.path.join(queue_dir,'finished'),'wb').close()
+
+if thread_errors:
+    raise thread_errors[0][0], thread_errors[0][1], thread_errors[0][2]
+
+summary_text = batch_sizer.summary_text()
+summary_file = open(os.path.join(output_dir, 'run_summary.txt'), 'wb')
+summary_file.write(summary_text)
+summary_file.close()
+print
+print summary_text